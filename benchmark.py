@@ -0,0 +1,136 @@
+"""
+Rough timings for a few expensive situations. Run with `python benchmark.py`.
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import importlib.util
+
+import stackprinter
+
+
+def timeit(name, f, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - tic)
+    print("%-55s %8.2f ms" % (name, 1000 * min(timings)))
+
+
+def make_long_function(n_lines=1000):
+    """
+    Import a module with a 1000-line function and get an exception from it
+    """
+    body = ["def long_function(x, y):\n"]
+    for k in range(n_lines):
+        body.append("    var_%d = x.real + y * %d  # line %d\n" % (k % 20, k, k))
+    body.append("    raise ValueError(var_0)\n")
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'long_module.py')
+    with open(path, 'w') as f:
+        f.writelines(body)
+
+    spec = importlib.util.spec_from_file_location('long_module', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    try:
+        module.long_function(1, 2)
+    except ValueError as e:
+        return e
+
+
+def make_long_module(n_lines=5000):
+    """
+    Get an exception raised at the end of a 5000-line module
+    """
+    body = ["x_%d = [%d,\n     %d]\n" % (k, k, k) for k in range(n_lines // 2)]
+    body.append("len(x_0) / 0\n")
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'long_script.py')
+    with open(path, 'w') as f:
+        f.writelines(body)
+
+    try:
+        exec(compile(''.join(body), path, 'exec'), {})
+    except ZeroDivisionError as e:
+        return e
+
+
+def bench_long_scope():
+    exc = make_long_function()
+    for annotator in ['tokenize', 'ast']:
+        for style in ['plaintext', 'darkbg2']:
+            timeit("1000-line scope, source_lines='all', %s, %s"
+                   % (style, annotator),
+                   lambda: stackprinter.format(exc, style=style,
+                                               source_lines='all',
+                                               annotator=annotator))
+
+
+def bench_long_module():
+    exc = make_long_module()
+    for lines in [5, 'all']:
+        timeit("5000-line module, source_lines=%r" % lines,
+               lambda: stackprinter.format(exc, source_lines=lines))
+
+
+def make_deep_stack(depth=200):
+    def recurse(n):
+        if n == 0:
+            raise ValueError('deep')
+        return recurse(n - 1)
+
+    try:
+        recurse(depth)
+    except ValueError as e:
+        return e
+
+
+def bench_library_frames():
+    """
+    A deep stack where all frames count as library code
+    """
+    exc = make_deep_stack()
+    for level in ['boring', 'line', 'hidden']:
+        timeit("200 library frames, suppressed_level=%r" % level,
+               lambda: stackprinter.format(exc, suppressed_paths=[__file__],
+                                           suppressed_level=level))
+
+
+def bench_executor():
+    """
+    A 1000-frame recursion, analysed serially and in thread & process pools
+    """
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 2000))
+    exc = make_deep_stack(1000)
+    for executor in [None, 'thread', 'process']:
+        timeit("1000-frame recursion, executor=%r" % executor,
+               lambda: stackprinter.format(exc, executor=executor))
+
+
+def bench_import(repeat=5):
+    """
+    Time `import stackprinter` in fresh interpreters
+    """
+    code = ("import time; tic = time.perf_counter(); import stackprinter; "
+            "print(time.perf_counter() - tic)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+        timings.append(float(out))
+    print("%-55s %8.2f ms" % ("import stackprinter", 1000 * min(timings)))
+
+
+if __name__ == '__main__':
+    print("python %s" % sys.version.split()[0])
+    bench_import()
+    bench_long_scope()
+    bench_long_module()
+    bench_library_frames()
+    bench_executor()
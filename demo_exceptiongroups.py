@@ -1,7 +1,7 @@
 # flake8: noqa
 
-# Exception groups (new in py 3.11) aren't supported so far,
-# but at least we fall back on the default message.
+# Exception groups (new in py 3.11): each sub-exception is rendered below
+# the group, and frames shared by all sub-exceptions are shown only once.
 
 import stackprinter
 stackprinter.set_excepthook()
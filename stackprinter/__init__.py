@@ -1,11 +1,34 @@
 import sys
 import types
 import warnings
-from threading import Thread
+import importlib
 from functools import wraps
 
-import stackprinter.formatting as fmt
-from stackprinter.tracing import TracePrinter, trace
+# The submodules (and whatever they import in turn) are only loaded once
+# they're needed, so that `import stackprinter` stays cheap, e.g. for command
+# line tools that just want to install the excepthook.
+_LAZY_ATTRS = {'TracePrinter': 'stackprinter.tracing',
+               'trace': 'stackprinter.tracing',
+               'fmt': 'stackprinter.formatting'}
+
+_SUBMODULES = ('annotation_store', 'colorschemes', 'extraction',
+               'formatting', 'frame_formatting', 'prettyprinting',
+               'source_inspection', 'tracing', 'utils', 'verbosity')
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        module = importlib.import_module(_LAZY_ATTRS[name])
+        value = module if name == 'fmt' else getattr(module, name)
+        globals()[name] = value
+        return value
+    elif name in _SUBMODULES:
+        return importlib.import_module('stackprinter.' + name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS) | set(_SUBMODULES))
 
 
 def _guess_thing(f):
@@ -64,6 +87,14 @@ def format(thing=None, **kwargs):
         stack = stackprinter.format(thread, **kwargs))
         ```
 
+    Pass an asyncio task to see the chain of coroutines it is currently
+    suspended in (or use `format_all_tasks` to get all tasks of a loop):
+        ```
+        task = asyncio.create_task(something())
+        # (...)
+        stack = stackprinter.format(task, **kwargs))
+        ```
+
     Note:
     This displays variable values as they are _at the time of formatting_. In
     multi-threaded programs, variables can change while we're busy walking
@@ -75,7 +106,7 @@ def format(thing=None, **kwargs):
 
     Params
     ---
-    thing: (optional) exception, sys.exc_info() tuple, frame or thread
+    thing: (optional) exception, sys.exc_info() tuple, frame, thread or task
         What to format. Defaults to the currently handled exception or current
         stack frame.
 
@@ -123,6 +154,27 @@ def format(thing=None, **kwargs):
         or
         `suppressed_paths=[re.compile(r"lib/python.*/site-packages/numpy")]`
 
+    suppressed_level: str
+        How to show frames in `suppressed_paths`, one of the levels listed
+        under `verbosity`. Default: 'boring', as described above. For stacks
+        with lots of library frames, 'line' or 'hidden' are much quicker.
+
+    verbosity: list of (regex pattern, level) tuples, or a function
+        Pick how much to show of each frame, depending on its code. The first
+        pattern that matches a frame's file path decides, levels are
+        'verbose', 'boring' (what `suppressed_paths` does), 'reduced',
+        'minimal', 'line' (looks like 'minimal', but is taken straight from
+        the code object and one line of the source file, without analysing
+        the frame at all) or 'hidden' (runs of hidden frames become a line
+        like "(12 frames in django/db/models hidden)"). Instead of rules,
+        this can be a function that gets a code object and returns a level
+        (or None, to leave the decision to `suppressed_paths`), or a
+        `stackprinter.verbosity.VerbosityPolicy`. Either way, the decision is
+        made once per code object, before anything else about the frame is
+        looked at. `suppressed_paths` still apply after these rules, or where
+        the function returns None.
+        Example: `verbosity=[(r"site-packages/django", 'hidden')]`
+
     suppressed_exceptions: list of exception classes
         Show less verbose formatting for exceptions in this list.
         By default, this list is `[KeyboardInterrupt]`. Set to `[]`
@@ -138,6 +190,44 @@ def format(thing=None, **kwargs):
         Example:
         `suppressed_vars=[r".*password.*",  r"certainobject\.certainproperty"]`
 
+    max_chain_length: int or None
+        Show at most this many exceptions of a chain of exceptions (those
+        linked via `raise ... from ...` or raised while handling another one).
+        The most recent ones are kept. Default: 100. None: no limit.
+
+    executor: None, 'thread', 'process' or a concurrent.futures.Executor
+        Opt in to finding & analysing the source code of frames in a pool of
+        workers, for very deep stacks. The pool gets one job per function
+        (not per frame), so deep recursions get much quicker. Variable values
+        never leave the calling thread, that's also where the frames are
+        rendered. 'thread' and 'process' start a pool on first use and then
+        keep reusing it. The output is the same as without this option.
+        Default: None
+
+    annotator: 'tokenize' or 'ast'
+        How to find the variables in the source code. 'tokenize' (default)
+        treats every name in the code as a variable. 'ast' reads them from a
+        syntax tree instead, which is quicker and doesn't mistake e.g. keyword
+        arguments of calls for variables. The code still gets tokenized for
+        coloring though, so with a colorful `style` it's actually slower.
+
+    dedupe_vals: bool
+        Show values that were already shown in an earlier frame (the same
+        object, like a `self` that's passed through many methods) as a
+        reference to that frame instead, e.g. `<same as self in run, line 42>`
+        -- where that's shorter than the value itself. Default: False
+
+    max_frames: int or None
+        Show at most this many frames of each stack or traceback: For deeper
+        ones, only the outermost and innermost frames are shown (by default,
+        half of them each), and a line like "(123 frames not shown)" takes
+        the place of the others, which aren't even looked at. Default: None
+
+    head_frames, tail_frames: int or None
+        How many of the outermost and innermost frames to show. Either one
+        also works without `max_frames`, then the other one defaults to 0.
+        With `max_frames`, they're cut down to fit (the outermost ones first).
+
     reverse: bool
         List the innermost frame first.
 
@@ -147,10 +237,14 @@ def format(thing=None, **kwargs):
         'auto' (default): do that if the main traceback is longer than 50 lines.
 
     """
+    import stackprinter.formatting as fmt
+
     if isinstance(thing, types.FrameType):
         return fmt.format_stack_from_frame(thing, **kwargs)
-    elif isinstance(thing, Thread):
+    elif _is_thread(thing):
         return format_thread(thing, **kwargs)
+    elif _is_task(thing):
+        return format_task(thing, **kwargs)
     elif isinstance(thing, Exception):
         exc_info = (thing.__class__, thing, thing.__traceback__)
         return format(exc_info, **kwargs)
@@ -159,7 +253,7 @@ def format(thing=None, **kwargs):
     else:
         raise ValueError("Can't format %s. "\
                          "Expected an exception instance, sys.exc_info() tuple,"\
-                         "a frame or a thread object." % repr(thing))
+                         "a frame, a thread or an asyncio task." % repr(thing))
 
 
 @_guess_thing
@@ -294,6 +388,177 @@ def remove_excepthook():
     sys.excepthook = sys.__excepthook__
 
 
+def warmup(modules=(), paths=(), background=True, annotator='tokenize',
+           load=None, save=None):
+    """
+    Prepare for tracebacks from some code before any errors happen
+
+    The first traceback through a piece of code is slowest: the source files
+    need to be read, `inspect` has to find out which file belongs to which
+    module, and the source of each frame needs to be found and analysed. This
+    does all of that ahead of time, for every function in the given modules
+    and files, and keeps the results in `annotation_store.default_store`,
+    which `format` etc consult before doing the work themselves.
+
+    Forked processes inherit the store, so calling this before forking
+    workers (e.g. in a preforking server) warms up all of them. Otherwise,
+    the store can also be saved to and loaded from a file.
+
+    Params
+    ---
+    modules: list of modules or module names
+        Packages include all of their submodules that have been imported so
+        far. Names of modules that haven't been imported yet get imported.
+
+    paths: list of paths
+        .py files or directories to search for them
+
+    background: bool
+        Do the work in a daemon thread (default) instead of right away.
+
+    annotator: 'tokenize' or 'ast'
+        Which annotator to prepare for, like the kwarg of `format`.
+
+    load: path (optional)
+        First load a store from this file, as written via `save`. This uses
+        pickle, so only load files you trust.
+
+    save: path (optional)
+        Save the store to this file when done.
+
+    Returns
+    ---
+    The background thread (so you can `join()` it if needed), or None.
+    """
+    import stackprinter.annotation_store as annotation_store
+    from threading import Thread
+
+    def work():
+        store = annotation_store.default_store
+        if load is not None:
+            store.load(load)
+        for path in annotation_store.find_source_files(modules, paths):
+            store.add_file(path, annotator)
+        if save is not None:
+            store.save(save)
+
+    if background:
+        thread = Thread(target=work, name='stackprinter-warmup', daemon=True)
+        thread.start()
+        return thread
+    work()
+
+
+def detach(exc, clear_frames=True, **kwargs):
+    """
+    Let go of an exception's frames, but keep what's needed to format it later
+
+    Exceptions hold on to all frames of their traceback, and those to all
+    their local variables -- so keeping exceptions around (in a retry queue,
+    for a deferred error report...) can pin a lot of memory. This replaces
+    the traceback of an exception (and of those chained to it) with a list of
+    `extraction.FrameInfo`s, in which variable values are already formatted
+    & truncated. `format(exc)` renders those like a normal traceback. They're
+    also picklable (the chain of exceptions is kept, too), so the exception
+    can be sent elsewhere for rendering -- see also `detaching`.
+
+    Params
+    ---
+    exc: exception
+
+    clear_frames: bool
+        Also clear the local variables of the traceback's frames, like
+        `traceback.clear_frames` (default True). Frames that are still
+        running, like the caller's, can't be cleared, and frames of generators
+        and coroutines are left alone (clearing them would finalize those
+        that are merely suspended).
+
+    **kwargs:
+        See `format`. These decide which source lines and variables are kept,
+        and how the values are formatted, so later calls to `format` can't
+        show more than that.
+
+    Returns
+    ---
+    The same exception, now with `exc.__traceback__` None and the frames in
+    `exc._stackprinter_frames`.
+    """
+    import stackprinter.formatting as fmt
+    return fmt.detach(exc, clear_frames=clear_frames, **kwargs)
+
+
+def detaching(func, **kwargs):
+    """
+    Wrap a function so that exceptions raised by it get `detach`ed
+
+    This is for functions that run in another process, like in a
+    `ProcessPoolExecutor` or `multiprocessing.Pool`: Their exceptions get
+    pickled & sent back without a traceback, but detached ones bring their
+    frames along (source code and the formatted variable values), and
+    `format` shows them as usual.
+        ```
+        with ProcessPoolExecutor() as pool:
+            future = pool.submit(stackprinter.detaching(work), arg)
+            try:
+                future.result()
+            except Exception as e:
+                stackprinter.show(e)  # (includes what happened in the worker)
+        ```
+
+    Params
+    ---
+    func: function
+        It needs to be picklable itself, i.e. importable by name, so this
+        can't be used as a decorator on it.
+
+    **kwargs:
+        See `detach`
+    """
+    return _DetachingCall(func, kwargs)
+
+
+class _DetachingCall():
+    # (a class, since closures can't be pickled & sent to other processes)
+    def __init__(self, func, kwargs):
+        self.func = func
+        self.kwargs = kwargs
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self.func(*args, **kwargs)
+        except BaseException as exc:
+            detach(exc, **self.kwargs)
+            # (minus the frame of this method)
+            exc._stackprinter_frames = exc._stackprinter_frames[1:]
+            raise
+
+
+def register_formatter(cls, func=None):
+    """
+    Use a custom function to format variable values of some type
+
+    E.g. for types whose repr is slow, huge or otherwise unhelpful:
+        ```
+        @stackprinter.register_formatter('pandas.DataFrame')
+        def format_df(df, truncation, max_depth, depth):
+            return "DataFrame %dx%d" % df.shape
+        ```
+
+    Params
+    ---
+    cls: type or string
+        The type (subclasses included), or its name as 'module.Name' so it
+        doesn't need to be imported beforehand. Any name the type can be
+        imported under works, it's looked up once the module is imported.
+
+    func: function (value, truncation, max_depth, depth) -> string
+        See `prettyprinting.register_formatter`. Omit this to use
+        `register_formatter` as a decorator.
+    """
+    from stackprinter.prettyprinting import register_formatter
+    return register_formatter(cls, func)
+
+
 def _is_running_in_ipython():
     try:
         return __IPYTHON__
@@ -341,7 +606,14 @@ def _is_exc_info(thing):
     return ((a is None or (isinstance(a, type) and BaseException in a.mro())) and
             (b is None or (isinstance(b, BaseException))))
 
+def _is_thread(thing):
+    # (same as for tasks below: if threading isn't loaded, there are none)
+    threading = sys.modules.get('threading')
+    return threading is not None and isinstance(thing, threading.Thread)
+
 def format_thread(thread, add_summary=False, **kwargs):
+    import stackprinter.formatting as fmt
+
     try:
         fr = sys._current_frames()[thread.ident]
     except KeyError:
@@ -354,3 +626,70 @@ def format_thread(thread, add_summary=False, **kwargs):
         msg = fmt.format_stack_from_frame(fr, **kwargs)
         msg_indented = '    ' + '\n    '.join(msg.split('\n')).strip()
         return "%r\n\n%s" % (thread, msg_indented)
+
+
+def _is_task(thing):
+    # no need to import asyncio just to find out that this isn't a task
+    asyncio = sys.modules.get('asyncio')
+    return asyncio is not None and isinstance(thing, asyncio.Task)
+
+def format_task(task, add_summary=False, **kwargs):
+    import stackprinter.formatting as fmt
+
+    frames = fmt.walk_coroutine(task.get_coro())
+    if not frames:
+        return "%r: no frames found" % task
+
+    return _format_task_stack(task, frames, **kwargs)
+
+def format_all_tasks(loop=None, **kwargs):
+    """
+    Render the await chains of all unfinished asyncio tasks of an event loop.
+
+    Tasks that are suspended at exactly the same places (same code, same
+    instruction, all the way down the await chain) are collapsed into one
+    entry, showing the variable values of one representative task only. This
+    keeps dumps of thousands of similar tasks both fast and readable.
+
+    Params
+    --
+    loop: event loop (optional)
+        Defaults to the running loop
+
+    **kwargs:
+        See `format`
+    """
+    import asyncio
+    import stackprinter.formatting as fmt
+
+    groups = {}
+    for task in asyncio.all_tasks(loop):
+        frames = fmt.walk_coroutine(task.get_coro())
+        key = tuple((fr.f_code, fr.f_lasti) for fr in frames)
+        groups.setdefault(key, []).append((task, frames))
+
+    msgs = []
+    for group in sorted(groups.values(), key=len, reverse=True):
+        task, frames = group[0]
+        if not frames:
+            msg = "%r: no frames found" % task
+        else:
+            msg = _format_task_stack(task, frames, **kwargs)
+        if len(group) > 1:
+            first_line, _, rest = msg.partition('\n')
+            msg = "%s\n(+ %d more tasks with the same await chain)\n%s" % (
+                first_line, len(group) - 1, rest)
+        msgs.append(msg)
+
+    return '\n\n'.join(msgs)
+
+def _format_task_stack(task, frames, add_summary=False, **kwargs):
+    import stackprinter.formatting as fmt
+
+    # (a fresh list, since this runs once per task group)
+    suppressed_paths = kwargs.get('suppressed_paths') or []
+    kwargs['suppressed_paths'] = list(suppressed_paths) + [r"lib/python.*/asyncio/"]
+
+    msg = fmt.format_stack(frames, **kwargs)
+    msg_indented = '    ' + '\n    '.join(msg.split('\n')).strip()
+    return "%r\n\n%s" % (task, msg_indented)
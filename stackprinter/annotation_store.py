@@ -0,0 +1,271 @@
+"""
+Keep source annotations around, so that the first traceback is as quick as any
+
+`source_inspection.annotate` is the slowest part of formatting a frame, and
+before the first traceback also come `inspect`'s module lookups and reading the
+files into the linecache. All of that can be done ahead of time (see
+`stackprinter.warmup`), and the annotations can be saved to a file and loaded
+elsewhere (e.g. in each worker process of a server).
+"""
+import os
+import sys
+import types
+import pickle
+import hashlib
+import inspect
+import marshal
+import linecache
+import importlib
+
+import stackprinter.source_inspection as si
+from stackprinter.utils import quiet_parse
+
+FORMAT_VERSION = 1
+
+
+class AnnotationStore():
+    """
+    The results of `source_inspection.annotate` and `inspect.getsourcelines`
+
+    Annotations are keyed by a hash of the annotated source (plus where it
+    starts in its file), and the source of each scope is only used while the
+    hash of its file is still the same. So nothing goes stale when a file
+    changes, and everything stays valid in other processes.
+    """
+
+    def __init__(self):
+        self._annotations = {}
+        self._sources = {}
+        self._file_digests = {}
+
+    def __len__(self):
+        return len(self._annotations)
+
+    def getsourcelines(self, code):
+        """
+        Like inspect.getsourcelines for a code object, but use a stored result
+        if there is one (and if the file hasn't changed since)
+        """
+        if self._sources:
+            known = self._sources.get((code.co_filename, code.co_firstlineno))
+            if known is not None:
+                file_digest, source_lines, startline = known
+                if file_digest == self._file_digest(code.co_filename):
+                    return source_lines, startline
+        return inspect.getsourcelines(code)
+
+    def annotate(self, source_lines, line_offset=0, lineno=0,
+                 annotator='tokenize'):
+        """
+        Like source_inspection.annotate, but use a stored result if there is one
+        """
+        if self._annotations and source_lines:
+            key = _key(source_lines, line_offset, annotator)
+            known = self._annotations.get(key)
+            if known is not None:
+                return at_line(known, line_offset, lineno)
+        return si.annotate(source_lines, line_offset, lineno,
+                           annotator=annotator)
+
+    def add(self, source_lines, line_offset, annotator='tokenize'):
+        """
+        Annotate a piece of source code & keep the result
+        """
+        key = _key(source_lines, line_offset, annotator)
+        if key not in self._annotations:
+            annotation = si.annotate(source_lines, line_offset, line_offset,
+                                     annotator=annotator)
+            self._annotations[key] = annotation[:-1]
+
+    def add_file(self, path, annotator='tokenize'):
+        """
+        Find & annotate each function (and class body etc) in a source file
+
+        Returns the number of scopes found.
+        """
+        file_digest = self._file_digest(path)
+        n_scopes = 0
+        for code, source_lines, startline in find_scopes(path):
+            key = (code.co_filename, code.co_firstlineno)
+            self._sources[key] = (file_digest, source_lines, startline)
+            self.add(source_lines, startline, annotator)
+            n_scopes += 1
+        return n_scopes
+
+    def _file_digest(self, path):
+        # (only hash each file once, as long as the linecache has the same
+        # lines for it)
+        lines = linecache.getlines(path)
+        known = self._file_digests.get(path)
+        if known is not None and known[0] is lines:
+            return known[1]
+        file_digest = _digest(lines)
+        self._file_digests[path] = (lines, file_digest)
+        return file_digest
+
+    def save(self, path):
+        """
+        Write everything to a file (as a pickle)
+        """
+        data = {'version': FORMAT_VERSION,
+                'annotations': dict(self._annotations),
+                'sources': dict(self._sources)}
+        with open(path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        """
+        Add everything from a file written by `save`
+
+        This unpickles the file, so only load files you trust.
+        """
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError("Can't load annotations of format version %r "
+                             "from %s" % (data.get('version'), path))
+        self._annotations.update(data['annotations'])
+        self._sources.update(data['sources'])
+
+    def clear(self):
+        self._annotations.clear()
+        self._sources.clear()
+        self._file_digests.clear()
+
+
+def annotate(source_lines, line_offset=0, lineno=0, annotator='tokenize'):
+    """
+    Like source_inspection.annotate, but use the default store
+    """
+    return default_store.annotate(source_lines, line_offset, lineno, annotator)
+
+
+def getsourcelines(code):
+    """
+    Like inspect.getsourcelines for a code object, but use the default store
+    """
+    return default_store.getsourcelines(code)
+
+
+def annotate_scope(scope, annotator='tokenize'):
+    """
+    Find & annotate the source of a scope, once for all frames running it
+
+    This is what the workers do in `StackFormatter._render_parallel`.
+
+    Params
+    ---
+    scope: code object, marshalled code object (bytes) or (source lines,
+        line number of the first line)
+
+    Returns
+    ---
+    (source lines, startline, annotation), where annotation is like the result
+    of `annotate` without the last element (see `at_line`). None if the
+    source of a code object can't be found.
+    """
+    if isinstance(scope, bytes):
+        # (code objects can't be pickled, but this works within one python)
+        scope = marshal.loads(scope)
+    if isinstance(scope, types.CodeType):
+        try:
+            source_lines, startline = getsourcelines(scope)
+        except Exception:
+            return None
+    else:
+        source_lines, startline = scope
+    annotation = annotate(source_lines, startline, startline, annotator)
+    return source_lines, startline, annotation[:-1]
+
+
+def at_line(annotation, line_offset, lineno):
+    """
+    Complete an annotation that's missing its last element for some line
+
+    i.e. add the line number as corrected for collapsed multiline statements
+    (see `source_inspection.annotate`)
+    """
+    source_map = annotation[0]
+    lineno += source_map.lineno_corrections[lineno - line_offset]
+    return annotation + (lineno,)
+
+
+def _key(source_lines, line_offset, annotator):
+    return _digest(source_lines), line_offset, annotator
+
+
+def _digest(lines):
+    source = ''.join(lines).encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(source, digest_size=16).digest()
+
+
+def find_scopes(path):
+    """
+    Find the source of each function (and class body etc) in a file
+
+    Yields (code object, source lines, line number of the first line), with
+    the source just like `extraction.get_source` would find it for frames
+    running that code.
+    """
+    from stackprinter.extraction import NON_FUNCTION_SCOPES
+
+    lines = linecache.getlines(path)
+    if not lines:
+        return
+
+    try:
+        module_code = quiet_parse(''.join(lines), path, compile_code=True)
+    except (SyntaxError, ValueError):
+        return
+
+    codes = [module_code]
+    while codes:
+        code = codes.pop()
+        codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+        if code.co_name in NON_FUNCTION_SCOPES:
+            continue
+        try:
+            source_lines, startline = inspect.getsourcelines(code)
+        except (OSError, TypeError, IndexError):
+            continue
+        yield code, source_lines, startline
+
+
+def find_source_files(modules=(), paths=()):
+    """
+    List the source files of some modules and paths
+
+    modules: modules or module names
+        Packages include all of their submodules that have been imported.
+        Module names that haven't been imported yet will be.
+
+    paths: paths of .py files or of directories to search for them
+    """
+    files = []
+    for module in modules:
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        names = [module.__name__]
+        if hasattr(module, '__path__'):
+            prefix = module.__name__ + '.'
+            names.extend(name for name in list(sys.modules)
+                         if name.startswith(prefix))
+        for name in names:
+            try:
+                files.append(inspect.getsourcefile(sys.modules[name]))
+            except (KeyError, TypeError):
+                pass
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, fname)
+                             for fname in sorted(filenames)
+                             if fname.endswith('.py'))
+        else:
+            files.append(path)
+
+    return [f for f in dict.fromkeys(files) if f]
+
+
+default_store = AnnotationStore()
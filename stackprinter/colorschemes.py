@@ -1,10 +1,21 @@
-import random
+import zlib
+
+from stackprinter.utils import get_ansi_tpl
 
 
 __all__ = ['color', 'darkbg', 'darkbg2', 'darkbg3',
            'lightbg', 'lightbg2', 'lightbg3']
 
 class ColorScheme():
+    hue_range = (0.05, 0.7)
+
+    def __init__(self):
+        # Palette slots handed out so far, by seed. One instance of a color
+        # scheme is shared by all frames of a rendering, so each variable gets
+        # the same color everywhere, and no two variables get the same color
+        # (until the palette runs out).
+        self._slots = {}
+        self._taken = set()
 
     def __getitem__(self, name):
         raise NotImplemented
@@ -12,6 +23,56 @@ class ColorScheme():
     def get_random(self):
         raise NotImplemented
 
+    def pick_hue(self, seed, sat, val):
+        """
+        Get a hue for some seed (usually a value's id, or a variable name)
+
+        Unlike a random pick, this avoids giving two different seeds the same
+        color, as long as there are free colors left in the palette.
+        """
+        palette = get_palette(self.hue_range, sat, val)
+        n_colors = len(palette)
+        slot = self._slots.get(seed)
+        if slot is None:
+            slot = _hash(seed) % n_colors
+            if len(self._taken) < n_colors:
+                while slot in self._taken:
+                    slot = (slot + 1) % n_colors
+                self._taken.add(slot)
+                self._slots[seed] = slot
+            # (else: we're out of colors, no need to remember this one)
+        return palette[slot % n_colors]
+
+
+_palettes = {}
+
+def get_palette(hue_range, sat, val):
+    """
+    List the hues in a range that come out as distinct 256-color ANSI codes
+    """
+    key = (hue_range, sat, val)
+    if key not in _palettes:
+        lo, hi = hue_range
+        runs = []
+        n_steps = 500
+        for k in range(n_steps + 1):
+            hue = lo + (hi - lo) * k / n_steps
+            code = get_ansi_tpl(hue, sat, val)
+            if runs and runs[-1][0] == code:
+                runs[-1][2] = hue
+            else:
+                runs.append([code, hue, hue])
+        # take the middle of each run of hues with the same code
+        _palettes[key] = [(start + end) / 2 for _, start, end in runs]
+    return _palettes[key]
+
+
+def _hash(seed):
+    # cheap and, unlike hash(str), the same in every python process
+    if not isinstance(seed, int):
+        seed = zlib.crc32(str(seed).encode('utf-8', 'replace'))
+    return ((seed * 2654435761) & 0xffffffff) >> 16
+
 
 class darkbg(ColorScheme):
                               # Hue, Sat, Val, Bold
@@ -31,20 +92,13 @@ class darkbg(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.4, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05,0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1. #1. if highlight else 0.5
         val = 0.5 #1. if highlight else 0.3
+        hue = self.pick_hue(seed, sat, val)
         bold = highlight
 
         return hue, sat, val, bold
@@ -69,20 +123,13 @@ class darkbg2(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.4, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05,0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1. if highlight else 1.
         val = 0.8 #if highlight else 0.5
+        hue = self.pick_hue(seed, sat, val)
         bold = highlight
 
         return hue, sat, val, bold
@@ -103,20 +150,13 @@ class darkbg3(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.4, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05,0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1. if highlight else 1.
         val = 0.8 if highlight else 0.5
+        hue = self.pick_hue(seed, sat, val)
         bold = highlight
 
         return hue, sat, val, bold
@@ -139,20 +179,13 @@ class lightbg(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.2, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05, 0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1.
         val = 0.5 #0.5 #0.6 if highlight else 0.2
+        hue = self.pick_hue(seed, sat, val)
         bold = highlight
 
         return hue, sat, val, bold
@@ -176,20 +209,13 @@ class lightbg2(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.2, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05, 0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1.
         val = 0.5
+        hue = self.pick_hue(seed, sat, val)
         bold = True
 
         return hue, sat, val, bold
@@ -212,20 +238,13 @@ class lightbg3(ColorScheme):
               'var_invisible':  (0.6, 0.4, 0.2, False)
              }
 
-    def __init__(self):
-        self.rng = random.Random()
-
     def __getitem__(self, name):
         return self.colors[name]
 
     def get_random(self, seed, highlight):
-        self.rng.seed(seed)
-
-        hue = self.rng.uniform(0.05, 0.7)
-        # if hue < 0:
-        #     hue = hue + 1
         sat = 1.
         val = 0.5
+        hue = self.pick_hue(seed, sat, val)
         bold = True
 
         return hue, sat, val, bold
@@ -1,8 +1,10 @@
+import re
+import dis
 import types
 import inspect
 from collections import OrderedDict, namedtuple
-from stackprinter.source_inspection import annotate
-from stackprinter.utils import match
+import stackprinter.annotation_store as annotation_store
+from stackprinter.utils import match, quiet_parse
 
 NON_FUNCTION_SCOPES =  ['<module>', '<lambda>', '<listcomp>']
 
@@ -16,8 +18,42 @@ class FrameInfo(_FrameInfo):
         return ("<FrameInfo %s, line %s, scope %s>" %
                 (self.filename, self.lineno, self.function))
 
-
-def get_info(tb_or_frame, lineno=None, suppressed_vars=[]):
+    @property
+    def line_bounds(self):
+        """
+        First and last line number in source_map, or (0, 0) if it's empty
+        """
+        return self.source_map.bounds()
+
+    def names_in_lines(self, lines):
+        """
+        Variable names that occur in some lines, each once, in order of
+        their first occurrence
+
+        lines: sorted list or range of line numbers
+        """
+        if (isinstance(lines, range) and lines.step == 1 and
+                lines.start <= self.line_bounds[0]):
+            # the common case of a range from the top of the scope: go by
+            # each name's first occurrence instead of visiting every line
+            # (name2lines is in order of first occurrence already)
+            return [name for name, lns in self.name2lines.items()
+                    if lns[0] < lines.stop]
+
+        names = {}
+        for ln in lines:
+            for name in self.line2names.get(ln, ()):
+                names[name] = True
+        return list(names)
+
+
+FrameSnapshot = namedtuple('FrameSnapshot',
+                           ['filename', 'function', 'lineno', 'source',
+                            'startline', 'local_vars', 'global_vars'])
+
+
+def get_info(tb_or_frame, lineno=None, suppressed_vars=[], context=None,
+             annotator='tokenize'):
     """
     Get a frame representation that's easy to format
 
@@ -31,6 +67,18 @@ def get_info(tb_or_frame, lineno=None, suppressed_vars=[]):
         back objects this defaults to the last executed line (tb.tb_lineno).
         For frame objects, it defaults the currently executed one (fr.f_lineno).
 
+    suppressed_vars: list of regex patterns
+        Don't look up the values of variables whose names match any of these.
+
+    context: (int, int) or None
+        How many lines before and after `lineno` will be looked at, at most.
+        For module-level code, this allows to analyse only the statements
+        around those lines instead of the whole file. None: the whole scope
+        is needed.
+
+    annotator: 'tokenize' or 'ast'
+        How to find the variables in the source, see source_inspection.annotate
+
 
     Returns
     ---
@@ -42,7 +90,7 @@ def get_info(tb_or_frame, lineno=None, suppressed_vars=[]):
 
          lineno: Highlighted line (last executed line)
 
-         source_map: OrderedDict
+         source_map: SourceMap (see source_inspection)
             Maps line numbers to a list of tokens. Each token is a (string, type)
             tuple. Concatenating the first elements of all tokens of all lines
             restores the original source, weird whitespaces/indentations and all
@@ -73,6 +121,40 @@ def get_info(tb_or_frame, lineno=None, suppressed_vars=[]):
     if isinstance(tb_or_frame, FrameInfo):
         return tb_or_frame
 
+    snapshot = get_snapshot(tb_or_frame, lineno, copy_locals=False,
+                            context=context)
+    return get_info_from_snapshot(snapshot, suppressed_vars,
+                                  annotator=annotator)
+
+
+def get_snapshot(tb_or_frame, lineno=None, copy_locals=True, context=None,
+                 find_source=True):
+    """
+    Collect everything get_info needs from a live frame, without analysing it
+
+    The result no longer depends on the frame (except through the values of
+    its variables), so the actual analysis (`get_info_from_snapshot`) can be
+    done later or in another thread.
+
+    Params
+    ---
+    tb_or_frame, lineno, context: see get_info
+
+    copy_locals: bool
+        Take a copy of the frame's local variables, so that the snapshot
+        doesn't change if the frame is still running.
+
+    find_source: bool
+        If False, leave the source of functions to be found later (from the
+        code object, see `annotation_store.getsourcelines`): the snapshot's
+        source and startline are None then. Module-level code (and other
+        NON_FUNCTION_SCOPES) still gets its source right away.
+
+    Returns
+    ---
+    FrameSnapshot, a named tuple of: filename, function, lineno, source (list
+    of str), startline (line number of source[0]), local_vars, global_vars
+    """
     if isinstance(tb_or_frame, types.TracebackType):
         tb = tb_or_frame
         lineno = tb.tb_lineno if lineno is None else lineno
@@ -94,30 +176,60 @@ def get_info(tb_or_frame, lineno=None, suppressed_vars=[]):
     filename = inspect.getsourcefile(frame) or inspect.getfile(frame)
     function = frame.f_code.co_name
 
-    try:
-        source, startline = get_source(frame)
-        # this can be slow (tens of ms) the first time it is called, since
-        # inspect.get_source internally calls inspect.getmodule, for no
-        # other purpose than updating the linecache. seems like a bad tradeoff
-        # for our case, but this is not the time & place to fork `inspect`.
-    except:
-        source = []
-        startline = lineno
+    if not find_source and function not in NON_FUNCTION_SCOPES:
+        source = startline = None
+    else:
+        try:
+            source, startline = get_source(frame, lineno, context)
+            # this can be slow (tens of ms) the first time it is called, since
+            # inspect.get_source internally calls inspect.getmodule, for no
+            # other purpose than updating the linecache. seems like a bad
+            # tradeoff for our case, but this is not the time & place to fork
+            # `inspect`.
+        except:
+            source = []
+            startline = lineno
+
+    local_vars = frame.f_locals
+    if copy_locals:
+        local_vars = dict(local_vars)
+
+    return FrameSnapshot(filename, function, lineno, source, startline,
+                         local_vars, frame.f_globals)
+
+
+def get_info_from_snapshot(snapshot, suppressed_vars=[], annotation=None,
+                           annotator='tokenize'):
+    """
+    Like get_info, but for a FrameSnapshot
 
-    source_map, line2names, name2lines, head_lns, lineno = annotate(source, startline, lineno)
+    annotation: tuple (optional)
+        The result of calling `source_inspection.annotate` on the snapshot's
+        source, startline and lineno, if that has already been done elsewhere.
 
+    annotator: see get_info
+    """
+    if annotation is None:
+        annotation = annotation_store.annotate(snapshot.source,
+                                               snapshot.startline,
+                                               snapshot.lineno,
+                                               annotator=annotator)
+    source_map, line2names, name2lines, head_lns, lineno = annotation
+
+    function = snapshot.function
     if function in NON_FUNCTION_SCOPES:
         head_lns = []
 
     names = name2lines.keys()
-    assignments = get_vars(names, frame.f_locals, frame.f_globals, suppressed_vars)
+    assignments = get_vars(names, snapshot.local_vars, snapshot.global_vars,
+                           suppressed_vars)
 
-    finfo =  FrameInfo(filename, function, lineno, source_map, head_lns,
-                       line2names, name2lines, assignments)
+    finfo =  FrameInfo(snapshot.filename, function, lineno, source_map,
+                       head_lns, line2names, name2lines, assignments)
     return finfo
 
 
-def get_source(frame):
+def get_source(frame, lineno=None, context=None):
     """
     get source lines for this frame
 
@@ -125,6 +237,10 @@ def get_source(frame):
     ---
     frame : frame object
 
+    lineno, context: int, (int, int) (optional)
+        If both are given, the source of module-level frames is clipped to
+        the statements around those lines (see `find_statement_window`).
+
     Returns
     ---
     lines : list of str
@@ -142,12 +258,101 @@ def get_source(frame):
     if frame.f_code.co_name in NON_FUNCTION_SCOPES:
         lines, _ = inspect.findsource(frame)
         startline = 1
+        if (lineno is not None and context is not None and
+                frame.f_code.co_name == '<module>'):
+            code_lines = {ln for _, ln in dis.findlinestarts(frame.f_code)}
+            window = find_statement_window(lines, lineno, *context,
+                                           code_lines=code_lines)
+            if window is not None:
+                start, stop = window
+                lines = lines[start:stop]
+                startline = start + 1
     else:
-        lines, startline = inspect.getsourcelines(frame)
+        lines, startline = annotation_store.getsourcelines(frame.f_code)
 
     return lines, startline
 
 
+# lines that can't be the first line of a top-level statement
+_NOT_A_STATEMENT = re.compile(r"[\s#)\]}]|(else|elif|except|finally)\b")
+
+
+def find_statement_window(lines, lineno, n_before, n_after, code_lines=None):
+    """
+    Find a stretch of whole top-level statements around some line of a file
+
+    Tokenizing a big module just to show the few lines around the current
+    one is a waste, but tokenizing only those lines can go wrong when they
+    start in the middle of a statement (e.g. inside a triple-quoted string).
+    So this extends the window to the nearest lines that look like the start
+    of a top-level statement, and then checks that the result parses (if it
+    doesn't, it tries a few wider windows). Starting inside brackets would be
+    fine by the way, those tokenize the same either way.
+
+    Params
+    ---
+    lines: list of str
+        the whole file
+
+    lineno: int
+        the interesting line (counting from 1)
+
+    n_before, n_after: int
+        nr of lines before and after lineno that should be in the window
+
+    code_lines: set of int (optional)
+        Line numbers where the module's code object has instructions. If
+        given, only these lines count as statement starts, which rules out
+        lines that are actually inside a string.
+
+    Returns
+    ---
+    (start, stop) indices into `lines`, or None if no window could be found
+    with confidence (or if it would be the whole file anyway)
+    """
+    n_lines = len(lines)
+    k = lineno - 1
+    if not 0 <= k < n_lines:
+        return None
+
+    def starts_statement(i):
+        if code_lines is not None and i + 1 not in code_lines:
+            return False
+        if _NOT_A_STATEMENT.match(lines[i]):
+            return False
+        if i == 0:
+            return True
+        previous = lines[i-1]
+        return not (previous.endswith('\\\n') or previous.startswith('@'))
+
+    def previous_start(i):
+        while i > 0 and not starts_statement(i):
+            i -= 1
+        return max(i, 0)
+
+    def next_start(i):
+        while i < n_lines and not starts_statement(i):
+            i += 1
+        return i
+
+    start = previous_start(max(k - n_before, 0))
+    stop = next_start(min(k + n_after + 1, n_lines))
+    for attempt in range(3):
+        if start == 0 and stop == n_lines:
+            return None
+
+        try:
+            quiet_parse(''.join(lines[start:stop]))
+        except (SyntaxError, ValueError):
+            # we probably cut through something multi-line, try a bit wider
+            start = previous_start(start - 1)
+            stop = next_start(stop + 1)
+        else:
+            return start, stop
+
+    return None
+
+
 def get_vars(names, loc, glob, suppressed_vars):
     assignments = []
     for name in names:
@@ -190,6 +395,16 @@ class CensoredVariable():
     def __repr__(self):
         return "*****"
 
+class RenderedValue():
+    """
+    Stand-in for a value that's already been formatted (see `stackprinter.detach`)
+    """
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
 class UnresolvedAttribute():
     """
     Container value for failed dot attribute lookups
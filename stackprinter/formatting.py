@@ -1,13 +1,24 @@
 """
 Various convnenience methods to walk stacks and concatenate formatted frames
 """
+import os
+import sys
+import copy
 import types
+import marshal
+import inspect
 import traceback
+from functools import partial
+from collections import OrderedDict
 
 import stackprinter.extraction as ex
+import stackprinter.verbosity as verbosity_policy
+import stackprinter.annotation_store as annotation_store
 import stackprinter.colorschemes as colorschemes
-from stackprinter.utils import match, get_ansi_tpl
-from stackprinter.frame_formatting import FrameFormatter, ColorfulFrameFormatter
+from stackprinter.utils import get_ansi_tpl
+from stackprinter.prettyprinting import format_value
+from stackprinter.frame_formatting import (FrameFormatter,
+                                          ColorfulFrameFormatter, ValueCache)
 
 
 def get_formatter(style, **kwargs):
@@ -17,6 +28,475 @@ def get_formatter(style, **kwargs):
         return ColorfulFrameFormatter(style, **kwargs)
 
 
+class StackFormatter():
+
+    def __init__(self, style='plaintext', source_lines=5, show_signature=True,
+                 show_vals='like_source', truncate_vals=500, line_wrap=60,
+                 suppressed_paths=None, suppressed_vars=[], executor=None,
+                 annotator='tokenize', dedupe_vals=False, max_frames=None,
+                 head_frames=None, tail_frames=None, verbosity=None,
+                 suppressed_level='boring'):
+        """
+        Formatter for lists of frames.
+
+        Like FrameFormatter, this is a partially applied function: It sets up
+        the frame formatters once, and then picks one of them for each frame
+        it is called with (depending on the frame's code, see `verbosity` and
+        `suppressed_paths`). It also remembers the FrameInfo of each frame
+        or traceback entry it has seen, so an instance can be reused to render
+        several overlapping stacks (like the tracebacks in an exception chain
+        or group) and each frame is only inspected once. Likewise, variable
+        values are formatted only once (see `frame_formatting.ValueCache`).
+
+        keyword args like stackprinter.format()
+        """
+        if executor not in [None, 'thread', 'process'] and not hasattr(executor, 'map'):
+            raise ValueError("executor must be None, 'thread', 'process' or "
+                             "an Executor, was %r" % executor)
+        min_src_lines = 0 if source_lines == 0 else 1
+
+        self.window = frame_window(max_frames, head_frames, tail_frames)
+        plain = style in ['plaintext', 'plain'] or not isinstance(style, str)
+        self.style = 'plaintext' if plain else style
+
+        if style not in ['plaintext', 'plain']:
+            # one color scheme instance for all frames, so that each
+            # variable keeps its color everywhere in the stack
+            style = getattr(colorschemes, style)()
+
+        # (also shared by all formatters, so that values that show up in
+        # several frames are formatted once, and deduplicated across frames)
+        value_cache = ValueCache()
+
+        self.minimal_formatter = get_formatter(style=style,
+                                               source_lines=min_src_lines,
+                                               show_signature=False,
+                                               show_vals=False,
+                                               annotator=annotator)
+
+        self.reduced_formatter = get_formatter(style=style,
+                                               source_lines=min_src_lines,
+                                               show_signature=show_signature,
+                                               show_vals=show_vals,
+                                               truncate_vals=truncate_vals,
+                                               line_wrap=line_wrap,
+                                               suppressed_paths=suppressed_paths,
+                                               suppressed_vars=suppressed_vars,
+                                               annotator=annotator,
+                                               dedupe_vals=dedupe_vals,
+                                               value_cache=value_cache)
+
+        self.verbose_formatter = get_formatter(style=style,
+                                               source_lines=source_lines,
+                                               show_signature=show_signature,
+                                               show_vals=show_vals,
+                                               truncate_vals=truncate_vals,
+                                               line_wrap=line_wrap,
+                                               suppressed_paths=suppressed_paths,
+                                               suppressed_vars=suppressed_vars,
+                                               annotator=annotator,
+                                               dedupe_vals=dedupe_vals,
+                                               value_cache=value_cache)
+
+        self.suppressed_paths = suppressed_paths
+        self.suppressed_vars = suppressed_vars
+        self.executor = executor
+        self.annotator = annotator
+        self.dedupe_vals = dedupe_vals
+        self.policy = verbosity_policy.get_policy(verbosity, suppressed_paths,
+                                                  suppressed_level)
+        # (bound once, so the plan can tell frames rendered this way by identity)
+        self.line_formatter = self.minimal_formatter.format_line
+        self._infos = {}
+
+        # all formatters share the same FrameInfos, so those need to cover
+        # as much source as the most demanding one wants to see
+        formatters = [self.minimal_formatter, self.reduced_formatter,
+                      self.verbose_formatter]
+        if any(f.context is None for f in formatters):
+            self.context = None
+        else:
+            self.context = tuple(map(max, *(f.context for f in formatters)))
+
+    def __call__(self, frames, reverse=False):
+        """
+        Render a list of frames, traceback entries (or FrameInfo tuples)
+        """
+        stack, _ = self.format_with_summary(frames, reverse, add_summary=False)
+        return stack
+
+    def format_with_summary(self, frames, reverse=False, add_summary='auto',
+                            auto_summary_lines=50):
+        """
+        Render a list of frames, and at the same time a summary of them
+
+        add_summary: True, False, 'auto'
+            'auto': only make a summary if the stack is longer than
+            `auto_summary_lines` lines
+
+        Returns
+        ---
+        stack: string
+
+        summary: string or None
+            The frames with 1 line of source context each and no variable
+            values (as in `summary()`), or None if no summary was wanted.
+        """
+        frame_msgs = []
+        summary_msgs = []
+        rendered = []
+        n_lines = 0
+        auto = add_summary == 'auto'
+        summarize = bool(add_summary) and not auto
+        if self.executor is None:
+            rendered_frames = self._render(frames)
+        else:
+            rendered_frames = self._render_parallel(frames)
+
+        for fi, formatter, frame_msg in rendered_frames:
+            frame_msgs.append(frame_msg if formatter else frame_msg + '\n')
+
+            if auto:
+                # count only as far as needed to decide
+                rendered.append((fi, formatter, frame_msg))
+                n_lines += frame_msg.count('\n')
+                if n_lines > auto_summary_lines:
+                    # catch up on the frames we've seen so far
+                    auto = False
+                    summarize = True
+                    summary_msgs = [self._summarize(*r) for r in rendered]
+            elif summarize:
+                summary_msgs.append(self._summarize(fi, formatter, frame_msg))
+
+        if reverse:
+            frame_msgs = reversed(frame_msgs)
+            summary_msgs = reversed(summary_msgs)
+
+        stack = ''.join(frame_msgs)
+        summary = ''.join(summary_msgs) if summarize else None
+        return stack, summary
+
+    def summary(self, frames, reverse=False):
+        """
+        Render a list of frames with 1 line of source context, no variable values.
+        """
+        frame_msgs = [self.minimal_formatter(self.get_info(frame))
+                      if msg is None else msg
+                      for frame, formatter, msg in self._plan(frames)]
+        if reverse:
+            frame_msgs = reversed(frame_msgs)
+
+        return ''.join(frame_msgs)
+
+    def _skip_frames(self, frames):
+        """
+        Leave out the frames between the ends of a long stack (see max_frames)
+
+        Returns the remaining frames, and None or (position, number) of the
+        skipped ones.
+        """
+        if self.window is None:
+            return frames, None
+
+        frames = list(frames)
+        n_head, n_tail = self.window
+        n_skipped = len(frames) - n_head - n_tail
+        if n_skipped <= 0:
+            return frames, None
+
+        frames = frames[:n_head] + frames[len(frames) - n_tail:]
+        return frames, (n_head, n_skipped)
+
+    def _gap_msg(self, n_skipped):
+        return _style_hint("(%d frames not shown)\n" % n_skipped, self.style)
+
+    def _plan(self, frames):
+        """
+        Pick a formatter for each frame, before looking at any of them closely
+
+        Returns a list of (frame, formatter, message). The message is None for
+        frames that still need to be analysed & rendered, but frames on the
+        LINE level are rendered right away, and runs of hidden frames (as well
+        as the frames skipped in deep stacks, see max_frames) are replaced by
+        (None, None, message about them).
+        """
+        frames, gap = self._skip_frames(frames)
+        if gap:
+            n_head, n_skipped = gap
+            # (mark the spot, so runs of hidden frames stop there)
+            frames = frames[:n_head] + [None] + frames[n_head:]
+
+        plan = []
+        hidden = []
+        parent_is_boring = True
+        for frame in frames:
+            if frame is not None:
+                code = _code_of(frame)
+                formatter, is_boring = self._pick_formatter(self.policy(code),
+                                                            parent_is_boring)
+                if formatter is None:
+                    hidden.append(code.co_filename)
+                    continue
+            if hidden:
+                plan.append((None, None, self._hidden_msg(hidden)))
+                hidden = []
+            if frame is None:
+                plan.append((None, None, self._gap_msg(n_skipped)))
+                continue
+            if formatter is self.line_formatter:
+                plan.append((frame, formatter, formatter(frame)))
+            else:
+                plan.append((frame, formatter, None))
+            parent_is_boring = is_boring
+        if hidden:
+            plan.append((None, None, self._hidden_msg(hidden)))
+        return plan
+
+    def _render(self, frames):
+        """
+        Pick a formatter for each frame & render it
+
+        Yields (FrameInfo, formatter, string) for each frame, in order, with
+        None instead of a FrameInfo for frames that weren't analysed (and
+        also None instead of a formatter in place of hidden frames).
+        """
+        for frame, formatter, msg in self._plan(frames):
+            if msg is not None:
+                yield None, formatter, msg
+            else:
+                fi = self.get_info(frame)
+                yield fi, formatter, formatter(fi)
+
+    def _render_parallel(self, frames):
+        """
+        Like _render, but find & annotate the source code in a pool of workers
+
+        The workers get one job per scope (i.e. per code object), not per
+        frame, so deep recursions don't do the same work over and over.
+        Process pools get the code objects (marshalled) and find the source
+        themselves, where that works. Everything that needs the live frames
+        or the variable values (looking up variables, rendering) happens
+        here, in the calling thread & in frame order, so the output is
+        exactly the same as from _render.
+        """
+        jobs = []
+        rendered = {}
+        scopes = {}
+        for frame, formatter, msg in self._plan(frames):
+            if msg is not None:
+                # (remember where these go between the others, see below)
+                rendered.setdefault(len(jobs), []).append((None, formatter, msg))
+                continue
+            key = self._cache_key(frame)
+            fi = frame if key is None else self._infos.get(key)
+            scope = None
+            if fi is None:
+                fi = ex.get_snapshot(frame, context=self.context,
+                                     find_source=False)
+                if fi.source is None:
+                    scope = _code_of(frame)
+                else:
+                    # (module-level code, see get_snapshot)
+                    scope = (fi.source, fi.startline)
+                scopes[id(scope)] = scope
+            jobs.append((key, fi, formatter, id(scope)))
+
+        executor = self.executor
+        if executor in ['thread', 'process']:
+            executor = _shared_pool(executor)
+        from concurrent.futures import ProcessPoolExecutor
+        to_send = list(scopes.values())
+        chunksize = 1
+        if isinstance(executor, ProcessPoolExecutor):
+            to_send = [marshal.dumps(scope) if isinstance(scope, types.CodeType)
+                       else scope for scope in to_send]
+            # (a round trip per scope costs more than annotating most scopes)
+            chunksize = max(1, len(to_send) // (4 * (os.cpu_count() or 1)))
+        annotate = partial(annotation_store.annotate_scope,
+                           annotator=self.annotator)
+        annotations = dict(zip(scopes, executor.map(annotate, to_send,
+                                                    chunksize=chunksize)))
+
+        for k, (key, fi, formatter, scope_id) in enumerate(jobs):
+            yield from rendered.get(k, [])
+            if isinstance(fi, ex.FrameSnapshot):
+                fi = self._complete_snapshot(fi, scopes[scope_id],
+                                             annotations[scope_id])
+                if key is not None:
+                    self._infos[key] = fi
+            yield fi, formatter, formatter(fi)
+        yield from rendered.get(len(jobs), [])
+
+    def _complete_snapshot(self, snapshot, scope, result):
+        """
+        Make a FrameInfo from a snapshot without source & a worker's result
+        """
+        if result is None:
+            # (the worker couldn't find the source, e.g. because it's only in
+            # this process's linecache -- try again here)
+            result = annotation_store.annotate_scope(scope, self.annotator)
+        if result is None:
+            source, startline = [], snapshot.lineno
+            annotation = annotation_store.annotate(source, startline,
+                                                   snapshot.lineno,
+                                                   annotator=self.annotator)
+        else:
+            source, startline, annotation = result
+            annotation = annotation_store.at_line(annotation, startline,
+                                                  snapshot.lineno)
+        snapshot = snapshot._replace(source=source, startline=startline)
+        return ex.get_info_from_snapshot(snapshot, self.suppressed_vars,
+                                         annotation)
+
+    def _pick_formatter(self, level, parent_is_boring):
+        """
+        Returns the formatter for a verbosity level (None for HIDDEN) & whether
+        frames with that level count as boring
+        """
+        if level == verbosity_policy.VERBOSE:
+            return self.verbose_formatter, False
+        elif level == verbosity_policy.BORING:
+            if parent_is_boring:
+                return self.minimal_formatter, True
+            else:
+                return self.reduced_formatter, True
+        elif level == verbosity_policy.REDUCED:
+            return self.reduced_formatter, True
+        elif level == verbosity_policy.MINIMAL:
+            return self.minimal_formatter, True
+        elif level == verbosity_policy.LINE:
+            return self.line_formatter, True
+        elif level == verbosity_policy.HIDDEN:
+            return None, True
+        else:
+            # a formatter of the policy's own
+            return level, False
+
+    def _hidden_msg(self, filenames):
+        where = _common_location(filenames)
+        if where:
+            msg = "(%d frames in %s hidden)\n" % (len(filenames), where)
+        else:
+            msg = "(%d frames hidden)\n" % len(filenames)
+        return _style_hint(msg, self.style)
+
+    def _summarize(self, fi, formatter, frame_msg):
+        # frames that got the minimal treatment look the same in the summary
+        # (so do the ones that weren't analysed & the messages about hidden ones)
+        if formatter is self.minimal_formatter or fi is None:
+            return frame_msg
+        return self.minimal_formatter(fi)
+
+    def get_info(self, frame):
+        """
+        Like extraction.get_info, but only once per frame & highlighted line
+        """
+        key = self._cache_key(frame)
+        if key is None:
+            return frame
+
+        if key not in self._infos:
+            self._infos[key] = ex.get_info(frame,
+                                           suppressed_vars=self.suppressed_vars,
+                                           context=self.context,
+                                           annotator=self.annotator)
+        return self._infos[key]
+
+    @staticmethod
+    def _cache_key(frame):
+        if isinstance(frame, ex.FrameInfo):
+            return None
+        elif isinstance(frame, types.TracebackType):
+            return (id(frame.tb_frame), frame.tb_lineno)
+        else:
+            return (id(frame), frame.f_lineno)
+
+_pools = {}
+
+def _shared_pool(kind):
+    """
+    The pool for executor='thread' or 'process', started once & then reused
+    """
+    if kind not in _pools:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        if kind == 'thread':
+            _pools[kind] = ThreadPoolExecutor()
+        else:
+            _pools[kind] = ProcessPoolExecutor()
+    return _pools[kind]
+
+
+def _code_of(frame):
+    if isinstance(frame, types.TracebackType):
+        return frame.tb_frame.f_code
+    elif isinstance(frame, types.FrameType):
+        return frame.f_code
+    else:
+        return verbosity_policy.CodeInfo(frame.filename, frame.function)
+
+
+def _common_location(filenames):
+    """
+    Short name for the directory (or file) that all of these files are in
+
+    That's the path relative to the entry of sys.path it's in (so it reads
+    like a package, e.g. 'django/db/models' for files anywhere in there), or
+    the whole common path if it's not in any. None if the files have nothing
+    in common.
+    """
+    try:
+        common = os.path.commonpath(filenames)
+    except ValueError:
+        # (mix of absolute & relative paths, or paths on different drives)
+        return None
+    if not common or common == os.path.dirname(common):
+        # (nothing, or just the root directory)
+        return None
+
+    import_root = None
+    for entry in sys.path:
+        if not entry:
+            continue
+        entry = os.path.abspath(entry)
+        if (common.startswith(entry.rstrip(os.sep) + os.sep) and
+                (import_root is None or len(entry) > len(import_root))):
+            import_root = entry
+    if import_root is None:
+        return common
+    return os.path.relpath(common, import_root)
+
+
+def frame_window(max_frames=None, head_frames=None, tail_frames=None):
+    """
+    How many frames to keep at each end of a stack, see stackprinter.format()
+
+    Returns (n_head, n_tail), or None if there's no limit.
+    """
+    for name, n in [('max_frames', max_frames), ('head_frames', head_frames),
+                    ('tail_frames', tail_frames)]:
+        if n is not None and (not isinstance(n, int) or n < 0):
+            raise ValueError("%s must be None or an int >= 0, was %r" % (name, n))
+
+    if max_frames is None:
+        if head_frames is None and tail_frames is None:
+            return None
+    elif head_frames is None and tail_frames is None:
+        head_frames = max_frames // 2
+        tail_frames = max_frames - head_frames
+    elif head_frames is None:
+        head_frames = max(max_frames - tail_frames, 0)
+    elif tail_frames is None:
+        tail_frames = max(max_frames - head_frames, 0)
+
+    head_frames = head_frames or 0
+    tail_frames = tail_frames or 0
+    if max_frames is not None:
+        # (never more than max_frames in total, the head comes first)
+        head_frames = min(head_frames, max_frames)
+        tail_frames = min(tail_frames, max_frames - head_frames)
+    return head_frames, tail_frames
+
+
 def format_summary(frames, style='plaintext', source_lines=1, reverse=False,
                    **kwargs):
     """
@@ -24,75 +504,39 @@ def format_summary(frames, style='plaintext', source_lines=1, reverse=False,
 
     keyword args like stackprinter.format()
     """
-    min_src_lines = 0 if source_lines == 0 else 1
-    minimal_formatter = get_formatter(style=style,
-                                      source_lines=min_src_lines,
-                                      show_signature=False,
-                                      show_vals=False)
-
-    frame_msgs = [minimal_formatter(frame) for frame in frames]
-    if reverse:
-        frame_msgs = reversed(frame_msgs)
-
-    return ''.join(frame_msgs)
+    stack_formatter = StackFormatter(style=style, source_lines=source_lines)
+    return stack_formatter.summary(frames, reverse=reverse)
 
 
 def format_stack(frames, style='plaintext', source_lines=5,
                  show_signature=True, show_vals='like_source',
                  truncate_vals=500, line_wrap=60, reverse=False,
-                 suppressed_paths=None, suppressed_vars=[]):
+                 suppressed_paths=None, suppressed_vars=[], executor=None,
+                 annotator='tokenize', dedupe_vals=False, max_frames=None,
+                 head_frames=None, tail_frames=None, verbosity=None,
+                 suppressed_level='boring'):
     """
     Render a list of frames (or FrameInfo tuples)
 
     keyword args like stackprinter.format()
     """
-
-
-    min_src_lines = 0 if source_lines == 0 else 1
-
-    minimal_formatter = get_formatter(style=style,
-                                      source_lines=min_src_lines,
-                                      show_signature=False,
-                                      show_vals=False)
-
-    reduced_formatter = get_formatter(style=style,
-                                      source_lines=min_src_lines,
-                                      show_signature=show_signature,
-                                      show_vals=show_vals,
-                                      truncate_vals=truncate_vals,
-                                      line_wrap=line_wrap,
-                                      suppressed_paths=suppressed_paths,
-                                      suppressed_vars=suppressed_vars)
-
-    verbose_formatter = get_formatter(style=style,
-                                      source_lines=source_lines,
-                                      show_signature=show_signature,
-                                      show_vals=show_vals,
-                                      truncate_vals=truncate_vals,
-                                      line_wrap=line_wrap,
-                                      suppressed_paths=suppressed_paths,
-                                      suppressed_vars=suppressed_vars)
-
-    frame_msgs = []
-    parent_is_boring = True
-    for frame in frames:
-        fi = ex.get_info(frame, suppressed_vars=suppressed_vars)
-        is_boring = match(fi.filename, suppressed_paths)
-        if is_boring:
-            if parent_is_boring:
-                formatter = minimal_formatter
-            else:
-                formatter = reduced_formatter
-        else:
-            formatter = verbose_formatter
-
-        parent_is_boring = is_boring
-        frame_msgs.append(formatter(fi))
-
-    if reverse:
-        frame_msgs = reversed(frame_msgs)
-
-    return ''.join(frame_msgs)
+    stack_formatter = StackFormatter(style=style,
+                                     source_lines=source_lines,
+                                     show_signature=show_signature,
+                                     show_vals=show_vals,
+                                     truncate_vals=truncate_vals,
+                                     line_wrap=line_wrap,
+                                     suppressed_paths=suppressed_paths,
+                                     suppressed_vars=suppressed_vars,
+                                     executor=executor,
+                                     annotator=annotator,
+                                     dedupe_vals=dedupe_vals,
+                                     max_frames=max_frames,
+                                     head_frames=head_frames,
+                                     tail_frames=tail_frames,
+                                     verbosity=verbosity,
+                                     suppressed_level=suppressed_level)
+    return stack_formatter(frames, reverse=reverse)
 
 
 def format_stack_from_frame(fr, add_summary=False, **kwargs):
@@ -114,7 +558,7 @@ def format_stack_from_frame(fr, add_summary=False, **kwargs):
 
 def format_exc_info(etype, evalue, tb, style='plaintext', add_summary='auto',
                     reverse=False, suppressed_exceptions=[KeyboardInterrupt],
-                    suppressed_vars=[], **kwargs):
+                    max_chain_length=100, **kwargs):
     """
     Format an exception traceback, including the exception message
 
@@ -123,102 +567,269 @@ def format_exc_info(etype, evalue, tb, style='plaintext', add_summary='auto',
     if etype is None:
         etype = type(None)
 
-    if etype.__name__ == 'ExceptionGroup':
-        # Exception groups (new in py 3.11) aren't supported so far,
-        # but at least we fall back on the default message.
-        return ''.join(traceback.format_exception(etype, evalue, tb))
+    try:
+        stack_formatter = StackFormatter(style=style, **kwargs)
+        msg = _format_exc_info(etype, evalue, tb, stack_formatter,
+                               style=style,
+                               add_summary=add_summary,
+                               reverse=reverse,
+                               suppressed_exceptions=suppressed_exceptions,
+                               max_chain_length=max_chain_length,
+                               seen=set())
+
+    except Exception as exc:
+        import os
+        if 'PY_STACKPRINTER_DEBUG' in os.environ:
+            raise
+
+        our_tb = traceback.format_exception(exc.__class__,
+                                            exc,
+                                            exc.__traceback__,
+                                            chain=False)
+        where = getattr(exc, 'where', None)
+        context = " while formatting " + str(where) if where else ''
+        msg = 'Stackprinter failed%s:\n%s\n' % (context, ''.join(our_tb[-2:]))
+        msg += 'So here is your original traceback at least:\n\n'
+        msg += ''.join(traceback.format_exception(etype, evalue, tb))
+
+
+    return msg
+
+
+def _format_exc_info(etype, evalue, tb, stack_formatter, style, add_summary,
+                     reverse, suppressed_exceptions, max_chain_length, seen,
+                     n_skip=0):
+    """
+    Format an exception, preceded by any exceptions chained to it
+
+    stack_formatter: StackFormatter
+        shared by everything rendered as part of one call to format_exc_info
+
+    seen: set
+        ids of the exceptions rendered so far (to break reference cycles)
+
+    n_skip: int
+        leave out this many of the outermost traceback entries (because
+        they were already shown as part of an exception group)
+    """
+    # TODO: refactor this whole messy function to return a
+    # more... structured datastructure before assembling a string,
+    # so that e.g. a summary of the whole chain can be shown at
+    # the end.
+    chain, n_omitted = _walk_exception_chain(evalue, seen, max_chain_length)
 
     msg = ''
-    try:
-        # First, recursively format any chained exceptions (exceptions
-        # during whose handling the given one happened).
-        # TODO: refactor this whole messy function to return a
-        # more... structured datastructure before assembling a string,
-        # so that e.g. a summary of the whole chain can be shown at
-        # the end.
+    if n_omitted:
+        hint = "(%d earlier exceptions in this chain not shown)\n\n"
+        msg += _style_hint(hint % n_omitted, style)
+
+    for chained_exc, chain_hint in chain[:-1]:
+        msg += _format_single_exc(chained_exc.__class__,
+                                  chained_exc,
+                                  chained_exc.__traceback__,
+                                  stack_formatter,
+                                  style=style,
+                                  add_summary=add_summary,
+                                  reverse=reverse,
+                                  suppressed_exceptions=suppressed_exceptions,
+                                  max_chain_length=max_chain_length,
+                                  seen=seen)
+        msg += _style_hint(chain_hint, style)
+
+    msg += _format_single_exc(etype, evalue, tb, stack_formatter,
+                              style=style,
+                              add_summary=add_summary,
+                              reverse=reverse,
+                              suppressed_exceptions=suppressed_exceptions,
+                              max_chain_length=max_chain_length,
+                              seen=seen,
+                              n_skip=n_skip)
+    return msg
+
+
+def _walk_exception_chain(evalue, seen, max_length):
+    """
+    Follow the `__cause__` / `__context__` links of an exception backwards
+
+    Returns
+    ---
+    list of (exception, hint) tuples, oldest exception first, where the hint
+    is the message that goes between the exception and the next one. The
+    given exception itself comes last, with hint None.
+
+    int: number of (older) exceptions left out because the chain was longer
+    than max_length. Exceptions in `seen` end the chain (so cyclic contexts
+    are harmless), and all exceptions in the chain are added to it.
+    """
+    chain = []
+    n_omitted = 0
+    hint = None
+    while True:
+        if max_length is None or len(chain) < max(max_length, 1):
+            chain.append((evalue, hint))
+        else:
+            n_omitted += 1
+
+        if evalue is None:
+            break
+        seen.add(id(evalue))
+
+        stored_chain = getattr(evalue, '_stackprinter_chain', None)
+        if stored_chain is not None:
+            # a detached exception: its chain was stored along with it,
+            # since pickling loses these links (see `detach`)
+            for evalue, hint in reversed(stored_chain):
+                if id(evalue) in seen:
+                    break
+                seen.add(id(evalue))
+                if max_length is None or len(chain) < max(max_length, 1):
+                    chain.append((evalue, hint))
+                else:
+                    n_omitted += 1
+            break
+
         context = getattr(evalue, '__context__', None)
         cause = getattr(evalue, '__cause__', None)
         suppress_context = getattr(evalue, '__suppress_context__', False)
         if cause:
-            chained_exc = cause
-            chain_hint = ("\n\nThe above exception was the direct cause "
-                          "of the following exception:\n\n")
+            evalue = cause
+            hint = ("\n\nThe above exception was the direct cause "
+                    "of the following exception:\n\n")
         elif context and not suppress_context:
-            chained_exc = context
-            chain_hint = ("\n\nWhile handling the above exception, "
-                          "another exception occurred:\n\n")
+            evalue = context
+            hint = ("\n\nWhile handling the above exception, "
+                    "another exception occurred:\n\n")
         else:
-            chained_exc = None
+            break
+
+        if id(evalue) in seen:
+            break
+
+    chain.reverse()
+    return chain, n_omitted
+
+
+def _format_single_exc(etype, evalue, tb, stack_formatter, style, add_summary,
+                       reverse, suppressed_exceptions, n_skip=0, **kwargs):
+    """
+    Format one exception from a chain (plus, for groups, its sub-exceptions)
+    """
+    parts = []
+    tb_entries = _traceback_entries(evalue, tb)[n_skip:]
+    if tb_entries:
+        if (suppressed_exceptions and
+            issubclass(etype, tuple(suppressed_exceptions))):
+            summary = stack_formatter.summary(tb_entries, reverse=reverse)
+            parts = [summary]
+        else:
+            whole_stack, summary = stack_formatter.format_with_summary(
+                tb_entries, reverse=reverse, add_summary=add_summary)
+            parts.append(whole_stack)
+
+            if summary is not None:
+                summary += '\n'
+                parts.append('---- (full traceback below) ----\n\n' if reverse else
+                             '---- (full traceback above) ----\n')
+                parts.append(summary)
+
+    exc = format_exception_message(etype, evalue, style=style)
+    parts.append('\n\n' if reverse else '')
+    parts.append(exc)
+
+    if reverse:
+        parts = reversed(parts)
+
+    msg = ''.join(parts)
 
-        if chained_exc:
-            msg += format_exc_info(chained_exc.__class__,
-                                   chained_exc,
-                                   chained_exc.__traceback__,
+    if _is_exception_group(evalue):
+        msg = msg.rstrip('\n')
+        msg += _format_sub_exceptions(evalue, stack_formatter, style=style,
+                                      reverse=reverse,
+                                      suppressed_exceptions=suppressed_exceptions,
+                                      **kwargs)
+
+    return msg
+
+
+def _format_sub_exceptions(group, stack_formatter, style, reverse, **kwargs):
+    """
+    Format the members of an exception group, each indented below the group
+
+    Traceback entries at the start of every member's traceback that are
+    shared by all of them (same frame, same line) are rendered only once,
+    ahead of the individual members.
+    """
+    excs = group.exceptions
+    n_excs = len(excs)
+    tbs = [_traceback_entries(exc, exc.__traceback__) for exc in excs]
+    # (members that were never raised have no traceback to share)
+    n_shared = _count_shared_entries([tb for tb in tbs if tb])
+
+    msg = ''
+    if n_shared:
+        hint = "\n\n---- %d sub-exceptions, all sharing these frames: ----\n\n"
+        n_sharing = sum(1 for tb in tbs if tb)
+        shared_stack = stack_formatter(tbs[0][:n_shared], reverse=reverse)
+        msg += _style_hint(hint % n_sharing, style)
+        msg += _indent(shared_stack.rstrip('\n'))
+
+    for k, (exc, tb) in enumerate(zip(excs, tbs)):
+        n_skip = n_shared if tb else 0
+        hint = "\n\n---- sub-exception %d of %d%s ----\n\n"
+        note = ' (continued from the shared frames above)' if n_skip else ''
+        msg += _style_hint(hint % (k + 1, n_excs, note), style)
+        exc_msg = _format_exc_info(exc.__class__, exc, exc.__traceback__,
+                                   stack_formatter,
                                    style=style,
-                                   add_summary=add_summary,
+                                   add_summary=False,
                                    reverse=reverse,
-                                   suppressed_vars=suppressed_vars,
+                                   n_skip=n_skip,
                                    **kwargs)
+        msg += _indent(exc_msg.rstrip('\n'))
 
-            if style == 'plaintext':
-                msg +=  chain_hint
-            else:
-                sc = getattr(colorschemes, style)
-                clr = get_ansi_tpl(*sc.colors['exception_type'])
-                msg += clr % chain_hint
-
-        # Now, actually do some formatting:
-        parts = []
-        if tb:
-            frameinfos = [ex.get_info(tb_, suppressed_vars=suppressed_vars)
-                          for tb_ in _walk_traceback(tb)]
-            if (suppressed_exceptions and
-                issubclass(etype, tuple(suppressed_exceptions))):
-                summary = format_summary(frameinfos, style=style,
-                                         reverse=reverse, **kwargs)
-                parts = [summary]
-            else:
-                whole_stack = format_stack(frameinfos, style=style,
-                                           reverse=reverse, **kwargs)
-                parts.append(whole_stack)
+    return msg
 
-                if add_summary == 'auto':
-                    add_summary = whole_stack.count('\n') > 50
 
-                if add_summary:
-                    summary = format_summary(frameinfos, style=style,
-                                             reverse=reverse, **kwargs)
-                    summary += '\n'
-                    parts.append('---- (full traceback below) ----\n\n' if reverse else
-                                 '---- (full traceback above) ----\n')
-                    parts.append(summary)
+def _count_shared_entries(tbs):
+    """
+    Count how many leading traceback entries several tracebacks have in common
+    """
+    n_shared = 0
+    if len(tbs) < 2:
+        return n_shared
+    for entries in zip(*tbs):
+        first = entries[0]
+        if not all(_same_entry(tb, first) for tb in entries):
+            break
+        n_shared += 1
+    return n_shared
 
-        exc = format_exception_message(etype, evalue, style=style)
-        parts.append('\n\n' if reverse else '')
-        parts.append(exc)
 
-        if reverse:
-            parts = reversed(parts)
+def _same_entry(a, b):
+    if isinstance(a, types.TracebackType) and isinstance(b, types.TracebackType):
+        return a.tb_frame is b.tb_frame and a.tb_lineno == b.tb_lineno
+    # (detached FrameInfos are shared the same way, see `detach`)
+    return a is b
 
-        msg += ''.join(parts)
 
-    except Exception as exc:
-        import os
-        if 'PY_STACKPRINTER_DEBUG' in os.environ:
-            raise
+def _is_exception_group(evalue):
+    # by name, to also catch the `exceptiongroup` backport on older pythons
+    return any(cls.__name__ == 'BaseExceptionGroup'
+               for cls in type(evalue).__mro__)
 
-        our_tb = traceback.format_exception(exc.__class__,
-                                            exc,
-                                            exc.__traceback__,
-                                            chain=False)
-        where = getattr(exc, 'where', None)
-        context = " while formatting " + str(where) if where else ''
-        msg = 'Stackprinter failed%s:\n%s\n' % (context, ''.join(our_tb[-2:]))
-        msg += 'So here is your original traceback at least:\n\n'
-        msg += ''.join(traceback.format_exception(etype, evalue, tb))
 
+def _style_hint(hint, style):
+    if style == 'plaintext':
+        return hint
+    else:
+        sc = getattr(colorschemes, style)
+        clr = get_ansi_tpl(*sc.colors['exception_type'])
+        return clr % hint
 
-    return msg
+
+def _indent(msg, indent='    '):
+    lines = msg.split('\n')
+    return '\n'.join(indent + line if line else line for line in lines)
 
 
 def format_exception_message(etype, evalue, tb=None, style='plaintext'):
@@ -242,6 +853,32 @@ def format_exception_message(etype, evalue, tb=None, style='plaintext'):
         return clr_head % type_str + clr_msg % val_str
 
 
+def walk_coroutine(coro):
+    """
+    Follow a chain of awaiting coroutines (or delegating generators) inwards
+
+    Returns the frames of all suspended (or running) links in the chain,
+    outermost first. The walk stops at the first awaitable that isn't itself
+    a coroutine, generator or async generator, e.g. a Future.
+    """
+    frames = []
+    while coro is not None:
+        if hasattr(coro, 'cr_frame'):
+            frame, coro = coro.cr_frame, coro.cr_await
+        elif hasattr(coro, 'gi_frame'):
+            frame, coro = coro.gi_frame, coro.gi_yieldfrom
+        elif hasattr(coro, 'ag_frame'):
+            frame, coro = coro.ag_frame, coro.ag_await
+        else:
+            break
+
+        if frame is None:
+            # finished (or not yet started, for generators)
+            break
+        frames.append(frame)
+    return frames
+
+
 def _walk_traceback(tb):
     """
     Follow a chain of traceback objects outwards
@@ -249,3 +886,129 @@ def _walk_traceback(tb):
     while tb:
         yield tb
         tb = tb.tb_next
+
+
+def _traceback_entries(evalue, tb):
+    """
+    The traceback entries of an exception, including any detached ones
+
+    (A detached exception that was raised again has a new traceback, which
+    leads to where the detached one starts.)
+    """
+    entries = list(_walk_traceback(tb))
+    detached = getattr(evalue, '_stackprinter_frames', None)
+    if detached:
+        entries.extend(detached)
+    return entries
+
+
+def detach(evalue, clear_frames=True, **kwargs):
+    """
+    Replace an exception's traceback with FrameInfos that don't need the frames
+
+    see stackprinter.detach() for docs
+    """
+    # (accept all kwargs of format_exc_info, but these don't matter here)
+    for key in ['add_summary', 'reverse', 'suppressed_exceptions',
+                'max_chain_length']:
+        kwargs.pop(key, None)
+
+    stack_formatter = StackFormatter(**kwargs)
+    formatter = stack_formatter.verbose_formatter
+    detached_infos = {}
+    rendered_vals = {}
+    tbs = []
+
+    # the whole chain, and the members of groups
+    detached = set()
+    todo = [evalue]
+    while todo:
+        root = todo.pop()
+        if root is None:
+            continue
+        chain, _ = _walk_exception_chain(root, set(), None)
+        # (pickling an exception loses its __cause__ & __context__, so keep
+        # the chain like this, too)
+        root._stackprinter_chain = chain[:-1]
+
+        for exc, _ in chain:
+            if id(exc) in detached:
+                continue
+            detached.add(id(exc))
+            if _is_exception_group(exc):
+                todo.extend(exc.exceptions)
+
+            tb = exc.__traceback__
+            infos = []
+            for entry in _walk_traceback(tb):
+                fi = stack_formatter.get_info(entry)
+                # (FrameInfos are shared where frames are, keep it that way)
+                if id(fi) not in detached_infos:
+                    detached_infos[id(fi)] = _detach_info(fi, formatter,
+                                                          rendered_vals)
+                infos.append(detached_infos[id(fi)])
+
+            exc._stackprinter_frames = infos + getattr(exc, '_stackprinter_frames', [])
+            exc.__traceback__ = None
+            tbs.append(tb)
+
+    # (only now, since chained exceptions can share frames)
+    if clear_frames:
+        for tb in tbs:
+            _clear_frames(tb)
+
+    return evalue
+
+
+# (clearing the frame of a suspended generator or coroutine finalizes it)
+_SUSPENDABLE = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+
+def _clear_frames(tb):
+    """
+    Like traceback.clear_frames, but leave generators & coroutines alone
+    """
+    for entry in _walk_traceback(tb):
+        frame = entry.tb_frame
+        if frame.f_code.co_flags & _SUSPENDABLE:
+            continue
+        try:
+            frame.clear()
+        except RuntimeError:
+            # (still running)
+            pass
+
+
+def _detach_info(fi, formatter, rendered_vals):
+    """
+    A copy of a FrameInfo with its visible values formatted in advance
+    """
+    _, visible = formatter.select_scope(fi)
+    assignments = OrderedDict()
+    for name, value in visible.items():
+        assignments[name] = _render_value(value, formatter.truncate_vals,
+                                          rendered_vals)
+    return fi._replace(assignments=assignments)
+
+
+def _render_value(value, truncation, rendered_vals, depth=0):
+    if isinstance(value, (ex.CensoredVariable, ex.RenderedValue)):
+        return value
+    elif isinstance(value, ex.UnresolvedAttribute):
+        # (format_value shows these in a special way, so keep them around)
+        value = copy.copy(value)
+        value.last_resolvable_value = _render_value(value.last_resolvable_value,
+                                                    truncation, rendered_vals,
+                                                    depth=1)
+        return value
+
+    # each value only once, so that `dedupe_vals` works the same as before
+    known = rendered_vals.get((id(value), depth))
+    if known is not None and known[0] is value:
+        return known[1]
+
+    # no wrapping or indentation yet, since that still depends on the name
+    # & format options, but truncated (which later just does nothing)
+    text = format_value(value, truncation=truncation, wrap=0, depth=depth)
+    rendered = ex.RenderedValue(text)
+    rendered_vals[(id(value), depth)] = (value, rendered)
+    return rendered
@@ -1,5 +1,6 @@
 import types
 import os
+import linecache
 
 from collections import OrderedDict
 import stackprinter.extraction as ex
@@ -7,7 +8,49 @@ import stackprinter.source_inspection as sc
 import stackprinter.colorschemes as colorschemes
 
 from stackprinter.prettyprinting import format_value
-from stackprinter.utils import inspect_callable, match, trim_source, get_ansi_tpl
+from stackprinter.utils import (inspect_callable, path_matcher, trim_source,
+                                merge_line_ranges, get_ansi_tpl)
+
+
+class ValueCache():
+    """
+    Formatted variable values, to share between the formatters of one stack
+
+    The same objects (`self`, some request or config) tend to show up in many
+    frames, so each value only gets formatted once per indentation etc. Values
+    are looked up by id, and kept alive here so that their ids stay valid --
+    so don't keep an instance around for longer than one traceback.
+    """
+
+    def __init__(self):
+        self._strings = {}
+        self._first_seen = {}
+
+    def format(self, value, indent, truncation, wrap):
+        """
+        Like prettyprinting.format_value, but only once per value & params
+        """
+        key = (id(value), indent, truncation, wrap)
+        known = self._strings.get(key)
+        if known is not None and known[0] is value:
+            return known[1]
+        val_str = format_value(value, indent=indent, truncation=truncation,
+                               wrap=wrap)
+        self._strings[key] = (value, val_str)
+        return val_str
+
+    def first_seen(self, value, name, where):
+        """
+        Returns (name, where) of the first sighting of this value
+
+        (which is the given name & place, if it wasn't seen before)
+        """
+        known = self._first_seen.get(id(value))
+        if known is not None and known[0] is value:
+            return known[1:]
+        self._first_seen[id(value)] = (value, name, where)
+        return name, where
+
 
 class FrameFormatter():
     headline_tpl = 'File "%s", line %s, in %s\n'
@@ -24,7 +67,8 @@ class FrameFormatter():
     def __init__(self, source_lines=5, source_lines_after=1,
                  show_signature=True, show_vals='like_source',
                  truncate_vals=500, line_wrap: int = 60,
-                 suppressed_paths=None, suppressed_vars=None):
+                 suppressed_paths=None, suppressed_vars=None,
+                 annotator='tokenize', dedupe_vals=False, value_cache=None):
         """
         Formatter for single frames.
 
@@ -70,6 +114,19 @@ class FrameFormatter():
 
             Example: To hide numpy internals from the traceback, set
             `suppressed_paths=[r"lib/python.*/site-packages/numpy"]`
+
+        annotator: 'tokenize' or 'ast' (default 'tokenize')
+            How to find the variables in the source code, see
+            `source_inspection.annotate`.
+
+        dedupe_vals: bool (default False)
+            Show values that were already shown before (in an earlier frame,
+            or under another name) as a reference to that place instead, if
+            that's shorter.
+
+        value_cache: ValueCache (optional)
+            Reuse the formatted values in there. Formatters that share an
+            instance also share what's been shown, for `dedupe_vals`.
         """
 
 
@@ -82,6 +139,10 @@ class FrameFormatter():
             raise ValueError("show_vals must be one of "
                              "%s, was %r" % (str(valid_gv), show_vals))
 
+        if annotator not in sc.ANNOTATORS:
+            raise ValueError("annotator must be one of "
+                             "%s, was %r" % (sc.ANNOTATORS, annotator))
+
         self.lines = source_lines
         self.lines_after = source_lines_after
         self.show_signature = show_signature
@@ -90,6 +151,20 @@ class FrameFormatter():
         self.line_wrap = line_wrap
         self.suppressed_paths = suppressed_paths
         self.suppressed_vars = suppressed_vars
+        self.annotator = annotator
+        self.dedupe_vals = dedupe_vals
+        if value_cache is None and dedupe_vals:
+            value_cache = ValueCache()
+        self.value_cache = value_cache
+        self._is_suppressed = path_matcher(suppressed_paths)
+        self._hidden = {}
+
+        # how many lines before & after the highlighted one we'll ever look
+        # at (None: all of them), so get_info can skip the rest of big modules
+        if source_lines == 'all' or show_vals == 'all':
+            self.context = None
+        else:
+            self.context = (max(source_lines - 1, 0), source_lines_after)
 
     def __call__(self, frame, lineno=None):
         """
@@ -124,7 +199,8 @@ class FrameFormatter():
                              "%s. Got %r" % (accepted_types, frame))
 
         try:
-            finfo = ex.get_info(frame, lineno, self.suppressed_vars)
+            finfo = ex.get_info(frame, lineno, self.suppressed_vars,
+                                self.context, self.annotator)
 
             return self._format_frame(finfo)
         except Exception as exc:
@@ -133,8 +209,34 @@ class FrameFormatter():
             exc.where = frame
             raise
 
+    def format_line(self, frame):
+        """
+        Render a frame's headline and current source line, without analysing it
+
+        This takes just the code object, line number and one line of the
+        source file (via linecache), so it's much cheaper than calling the
+        formatter -- but there's no syntax highlighting and no variables.
+        FrameInfo tuples get formatted normally.
+        """
+        if isinstance(frame, ex.FrameInfo):
+            return self._format_frame(frame)
+        elif isinstance(frame, types.TracebackType):
+            code, lineno = frame.tb_frame.f_code, frame.tb_lineno
+        else:
+            code, lineno = frame.f_code, frame.f_lineno
+        if lineno is None:
+            # (see extraction.get_info)
+            lineno = code.co_firstlineno
+
+        msg = self._format_headline(code.co_filename, lineno, code.co_name)
+        line = linecache.getline(code.co_filename, lineno).strip()
+        if line and self.lines != 0:
+            line = self._format_raw_line(line) + '\n'
+            msg += self._format_listing({lineno: line}, lineno)
+        return msg
+
     def _format_frame(self, fi):
-        msg = self.headline_tpl % (fi.filename, fi.lineno, fi.function)
+        msg = self._format_headline(fi.filename, fi.lineno, fi.function)
 
         source_map, assignments = self.select_scope(fi)
 
@@ -142,26 +244,28 @@ class FrameFormatter():
             source_lines = self._format_source(source_map)
             msg += self._format_listing(source_lines, fi.lineno)
         if assignments:
-            msg += self._format_assignments(assignments)
+            msg += self._format_assignments(assignments, fi)
         elif self.lines == 'all' or self.lines > 1 or self.show_signature:
             msg += '\n'
 
         return msg
 
+    def _format_headline(self, filename, lineno, function):
+        return self.headline_tpl % (filename, lineno, function)
+
     def _format_source(self, source_map):
-        lines = OrderedDict()
-        for ln in sorted(source_map):
-            lines[ln] = ''.join(st for st, _, in source_map[ln])
-        return lines
+        return {ln: source_map.line(ln) for ln in source_map}
+
+    def _format_raw_line(self, line):
+        return line
 
     def _format_listing(self, lines, lineno):
         ln_prev = None
-        msg = ""
+        msgs = []
         n_lines = len(lines)
-        for ln in sorted(lines):
-            line = lines[ln]
+        for ln, line in lines.items():
             if ln_prev and ln_prev != ln - 1:
-                msg += self.elipsis_tpl
+                msgs.append(self.elipsis_tpl)
             ln_prev = ln
 
             if n_lines > 1:
@@ -169,20 +273,17 @@ class FrameFormatter():
                     tpl = self.marked_sourceline_tpl
                 else:
                     tpl = self.sourceline_tpl
-                msg += tpl % (ln, line)
+                msgs.append(tpl % (ln, line))
             else:
-                msg += self.single_sourceline_tpl % line
+                msgs.append(self.single_sourceline_tpl % line)
 
-        msg += self.sep_source_below
-        return msg
+        msgs.append(self.sep_source_below)
+        return ''.join(msgs)
 
-    def _format_assignments(self, assignments):
+    def _format_assignments(self, assignments, fi):
         msgs = []
         for name, value in assignments.items():
-            val_str = format_value(value,
-                                   indent=len(name) + self.var_indent + 3,
-                                   truncation=self.truncate_vals,
-                                   wrap=self.line_wrap)
+            val_str = self._format_value(name, value, fi)
             assign_str = self.val_tpl % (name, val_str)
             msgs.append(assign_str)
         if len(msgs) > 0:
@@ -190,14 +291,32 @@ class FrameFormatter():
         else:
             return ''
 
+    def _format_value(self, name, value, fi):
+        indent = len(name) + self.var_indent + 3
+        if self.value_cache is None:
+            return format_value(value, indent=indent,
+                                truncation=self.truncate_vals,
+                                wrap=self.line_wrap)
+
+        val_str = self.value_cache.format(value, indent, self.truncate_vals,
+                                          self.line_wrap)
+        if self.dedupe_vals:
+            where = "%s, line %s" % (fi.function, fi.lineno)
+            first_name, first_where = self.value_cache.first_seen(value, name,
+                                                                  where)
+            if (first_name, first_where) != (name, where):
+                ref = "<same as %s in %s>" % (first_name, first_where)
+                if len(ref) < len(val_str):
+                    return ref
+        return val_str
+
     def select_scope(self, fi):
         """
         decide which lines of code and which variables will be visible
         """
         source_lines = []
-        minl, maxl = 0, 0
+        minl, maxl = fi.line_bounds
         if len(fi.source_map) > 0:
-            minl, maxl = min(fi.source_map), max(fi.source_map)
             lineno = fi.lineno
 
             if self.lines == 0:
@@ -211,16 +330,17 @@ class FrameFormatter():
                 stop = lineno + self.lines_after
                 start = max(start, minl)
                 stop = min(stop, maxl)
-                source_lines = list(range(start, stop + 1))
+                source_lines = range(start, stop + 1)
 
             if source_lines and self.show_signature:
-                source_lines = sorted(set(source_lines) | set(fi.head_lns))
+                source_lines = merge_line_ranges(fi.head_lns, source_lines)
 
         if source_lines:
             # Report a bit more info about a weird class of bug
             # that I can't reproduce locally.
-            if not set(source_lines).issubset(fi.source_map.keys()):
-                debug_vals = [source_lines, fi.head_lns, fi.source_map.keys()]
+            # (source_map covers all lines between its bounds)
+            if source_lines[0] < minl or source_lines[-1] > maxl:
+                debug_vals = [list(source_lines), fi.head_lns, (minl, maxl)]
                 info = ', '.join(str(p) for p in debug_vals)
                 raise Exception("Picked an invalid source context: %s" % info)
             trimmed_source_map = trim_source(fi.source_map, source_lines)
@@ -235,38 +355,59 @@ class FrameFormatter():
             elif self.show_vals == 'line':
                 val_lines = [lineno] if source_lines else []
 
-            # TODO refactor the whole blacklistling mechanism below:
-
-            def hide(name):
-                value = fi.assignments[name]
-                if callable(value):
-                    qualified_name, path, *_ = inspect_callable(value)
-                    is_builtin = value.__class__.__name__ == 'builtin_function_or_method'
-                    is_boring = is_builtin or (qualified_name == name) or (path is None)
-                    is_suppressed = match(path, self.suppressed_paths)
-                    return is_boring or is_suppressed
-                return False
-
-            visible_vars = (name for ln in val_lines
-                            for name in fi.line2names[ln]
-                            if name in fi.assignments)
-
-            visible_assignments = OrderedDict([(n, fi.assignments[n])
-                                               for n in visible_vars
-                                               if not hide(n)])
+            visible_assignments = OrderedDict()
+            for name in fi.names_in_lines(val_lines):
+                if name in fi.assignments:
+                    value = fi.assignments[name]
+                    if not self.hide(name, value):
+                        visible_assignments[name] = value
         else:
             visible_assignments = {}
 
         return trimmed_source_map, visible_assignments
 
 
+    def hide(self, name, value):
+        """
+        decide whether a variable is too boring to show (some callables are)
+        """
+        # TODO refactor the whole blacklistling mechanism below:
+        if not callable(value):
+            return False
+
+        # remember the decision per function, since the same ones (e.g.
+        # `self.method`) tend to show up in many frames. Bound methods are
+        # new objects on every lookup, so go by the underlying function.
+        func = getattr(value, '__func__', value)
+        key = (name, id(func))
+        cached = self._hidden.get(key)
+        if cached is not None and cached[0] is func:
+            return cached[1]
+
+        qualified_name, path, *_ = inspect_callable(value)
+        is_builtin = value.__class__.__name__ == 'builtin_function_or_method'
+        is_boring = is_builtin or (qualified_name == name) or (path is None)
+        hidden = is_boring or self._is_suppressed(path)
+
+        if len(self._hidden) > 1000:
+            self._hidden.clear()
+        self._hidden[key] = (func, hidden)
+        return hidden
+
+
 class ColorfulFrameFormatter(FrameFormatter):
 
     def __init__(self, style='darkbg', **kwargs):
         """
         See FrameFormatter - this just adds some ANSI color codes here and there
+
+        style: name of a color scheme, or a ColorScheme instance (formatters
+        that share an instance also share the choice of variable colors)
         """
-        self.colors = getattr(colorschemes, style)()
+        if isinstance(style, colorschemes.ColorScheme):
+            self.colors = style
+        else:
+            self.colors = getattr(colorschemes, style)()
 
         highlight = self.tpl('highlight')
         header = self.tpl('header')
@@ -280,15 +421,22 @@ class ColorfulFrameFormatter(FrameFormatter):
         self.elipsis_tpl = dots % super().elipsis_tpl
         self.sep_vars = dots % super().sep_vars
 
+        # token type -> template, for _format_source. Variables aren't in
+        # here, since they get their colors per frame (see _pick_colors)
+        bold = self.tpl('source_bold')
+        self._token_tpls = {sc.KEYWORD: bold,
+                            sc.OP: bold,
+                            sc.CALL: bold,
+                            sc.COMMENT: self.tpl('source_comment'),
+                            sc.RAW: self.tpl('source_default')}
+
         super().__init__(**kwargs)
 
     def tpl(self, name):
         return get_ansi_tpl(*self.colors[name])
 
     def _format_frame(self, fi):
-        basepath, filename = os.path.split(fi.filename)
-        sep = os.sep if basepath else ''
-        msg = self.headline_tpl % (basepath, sep, filename, fi.lineno, fi.function)
+        msg = self._format_headline(fi.filename, fi.lineno, fi.function)
         source_map, assignments = self.select_scope(fi)
 
         colormap = self._pick_colors(source_map, fi.name2lines, assignments, fi.lineno)
@@ -298,47 +446,38 @@ class ColorfulFrameFormatter(FrameFormatter):
             msg += self._format_listing(source_lines, fi.lineno)
 
         if assignments:
-            msg += self._format_assignments(assignments, colormap)
+            msg += self._format_assignments(assignments, fi, colormap)
         elif self.lines == 'all' or self.lines > 1 or self.show_signature:
             msg += '\n'
 
         return msg
 
+    def _format_headline(self, path, lineno, function):
+        basepath, filename = os.path.split(path)
+        sep = os.sep if basepath else ''
+        return self.headline_tpl % (basepath, sep, filename, lineno, function)
+
+    def _format_raw_line(self, line):
+        return self._token_tpls[sc.RAW] % line
+
     def _format_source(self, source_map, colormap, lineno):
-        bold_tp = self.tpl('source_bold')
-        default_tpl = self.tpl('source_default')
-        comment_tpl = self.tpl('source_comment')
+        token_tpls = self._token_tpls
+        default_tpl = token_tpls[sc.RAW]
+        var_tpls = {name: get_ansi_tpl(*clr) for name, clr in colormap.items()}
 
-        source_lines = OrderedDict()
+        source_lines = {}
         for ln in source_map:
-            line = ''
-            for snippet, ttype in source_map[ln]:
-                if ttype in [sc.KEYWORD, sc.OP]:
-                    line += bold_tp % snippet
-                elif ttype == sc.VAR:
-                    if snippet not in colormap:
-                        line += default_tpl % snippet
-                    else:
-                        hue, sat, val, bold = colormap[snippet]
-                        var_tpl = get_ansi_tpl(hue, sat, val, bold)
-                        line += var_tpl % snippet
-                elif ttype == sc.CALL:
-                    line += bold_tp % snippet
-                elif ttype == sc.COMMENT:
-                    line += comment_tpl % snippet
-                else:
-                    line += default_tpl % snippet
-            source_lines[ln] = line
+            source_lines[ln] = ''.join([
+                (var_tpls.get(snippet, default_tpl) if ttype == sc.VAR
+                 else token_tpls.get(ttype, default_tpl)) % snippet
+                for snippet, ttype in source_map.tokens(ln)])
 
         return source_lines
 
-    def _format_assignments(self, assignments, colormap):
+    def _format_assignments(self, assignments, fi, colormap):
         msgs = []
         for name, value in assignments.items():
-            val_str = format_value(value,
-                                   indent=len(name) + self.var_indent + 3,
-                                   truncation=self.truncate_vals,
-                                   wrap=self.line_wrap)
+            val_str = self._format_value(name, value, fi)
             assign_str = self.val_tpl % (name, val_str)
             hue, sat, val, bold = colormap.get(name, self.colors['var_invisible'])
             clr_str = get_ansi_tpl(hue, sat, val, bold) % assign_str
@@ -349,14 +488,13 @@ class ColorfulFrameFormatter(FrameFormatter):
             return ''
 
     def _pick_colors(self, source_map, name2lines, assignments, lineno):
-        # TODO refactor: pick a hash for each name across frames, _then_ color.
-        # Currently, colors are consistent across frames purely because there's
-        # a fixed map from hashes to colors. It's not bijective though. If colors
-        # were picked after hashing across all frames, that could be fixed.
+        # colors are consistent across frames (and distinct, as long as the
+        # palette lasts) because the color scheme hands them out, see
+        # ColorScheme.pick_hue
         colormap = {}
-        for line in source_map.values():
-            for name, ttype in line:
-                if name not in colormap and ttype == sc.VAR and name in assignments:
+        for ln in source_map:
+            for name in source_map.var_names(ln):
+                if name not in colormap and name in assignments:
                     value = assignments[name]
                     highlight = lineno in name2lines[name]
                     colormap[name] = self._pick_color(name, value, highlight)
@@ -1,18 +1,113 @@
 import os
+import sys
+import array
+import weakref
 
 from stackprinter.extraction import UnresolvedAttribute
 from stackprinter.utils import inspect_callable
 
-try:
-    import numpy as np
-except ImportError:
-    np = False
-
 MAXLEN_DICT_KEY_REPR = 25  # truncate dict keys to this nr of characters
+ARRAY_STATS_SAMPLE = 10000  # look at most at this many elements for array stats
 
 # TODO see where the builtin pprint module can be used instead of all this
 # (but how to extend it for e.g. custom np array printing?)
 
+# type -> formatter, and 'module.name' -> formatter for types that may not
+# even be imported (we don't want to import numpy just to register arrays).
+# Names move over to the types they refer to once their module is imported.
+_formatters = {}
+_formatters_by_name = {}
+
+# what each type actually gets formatted with, after looking through its mro
+_dispatch_cache = weakref.WeakKeyDictionary()
+
+
+def register_formatter(cls, func=None):
+    """
+    Use a custom function to format values of some type (and its subclasses)
+
+    This is meant for types whose repr is slow or unwieldy (data frames,
+    tensors, ORM objects...). Can also be used as a decorator.
+
+    Params
+    ---
+    cls: type or string
+        The type, or its name like 'pandas.DataFrame' (a module and the name
+        of the type in it), so the module doesn't have to be imported just for
+        this. The name gets looked up once the module is imported, so it can
+        be any name the type is available under (here, the type is actually
+        defined in pandas.core.frame).
+
+    func: function (value, truncation, max_depth, depth) -> string
+        `truncation`, `max_depth` and `depth` are as in `format_value`, for
+        passing on when formatting nested values. The result gets truncated,
+        wrapped and indented afterwards, so that's not this function's job.
+    """
+    if func is None:
+        return lambda func: register_formatter(cls, func)
+
+    if isinstance(cls, str):
+        _formatters_by_name[cls] = func
+    else:
+        _formatters[cls] = func
+    _dispatch_cache.clear()
+    return func
+
+
+def _find_formatter(cls, value):
+    if _formatters_by_name:
+        _resolve_names()
+
+    # like functools.singledispatch: use the most specific registered class
+    for base in cls.__mro__:
+        formatter = _formatters.get(base)
+        if formatter is None and _formatters_by_name:
+            name = '%s.%s' % (base.__module__, base.__qualname__)
+            formatter = _formatters_by_name.get(name)
+        if formatter is not None:
+            break
+    else:
+        if hasattr(cls, '__array_interface__'):
+            formatter = format_buffer
+        elif callable(value):
+            formatter = format_callable
+        else:
+            formatter = format_repr
+
+    _dispatch_cache[cls] = formatter
+    return formatter
+
+
+def _resolve_names():
+    """
+    Look up the types that formatters were registered for by name, as far as
+    their modules are imported by now
+    """
+    for name in list(_formatters_by_name):
+        cls = _resolve_name(name)
+        if cls is not None:
+            func = _formatters_by_name.pop(name)
+            # (a registration by the type itself wins)
+            _formatters.setdefault(cls, func)
+            _dispatch_cache.clear()
+
+
+def _resolve_name(name):
+    """
+    The type called e.g. 'pandas.DataFrame', if its module is imported yet
+    """
+    parts = name.split('.')
+    for k in range(len(parts) - 1, 0, -1):
+        module = sys.modules.get('.'.join(parts[:k]))
+        if module is None:
+            continue
+        thing = module
+        for attr in parts[k:]:
+            thing = getattr(thing, attr, None)
+        return thing if isinstance(thing, type) else None
+    return None
+
+
 def format_value(value, indent=0, truncation=None, wrap=60,
                  max_depth=2, depth=0):
     """
@@ -52,42 +147,16 @@ def format_value(value, indent=0, truncation=None, wrap=60,
                                    truncation=truncation, indent=3, depth=depth+1)
         val_str = val_tpl % (value.last_resolvable_name, lastval_str)
         indent = 10
-
-    elif isinstance(value, (list, tuple, set)):
-        val_str = format_iterable(value, truncation, max_depth, depth)
-
-    elif isinstance(value, dict):
-        val_str = format_dict(value, truncation, max_depth, depth)
-
-    elif np and isinstance(value, np.ndarray):
-        val_str = format_array(value, minimize=depth > 0)
-
-    elif callable(value):
-        name, filepath, method_owner, ln = inspect_callable(value)
-        filename = os.path.basename(filepath) if filepath is not None else None
-        if filename is None:
-            val_str = safe_repr(value)
-        elif method_owner is None:
-            name_s = safe_str(name)
-            filename_s = safe_str(filename)
-            ln_s = safe_str(ln)
-            val_str = "<function '%s' %s:%s>" % (name_s, filename_s, ln_s)
-        else:
-            name_s = safe_str(name)
-            filename_s = safe_str(filename)
-            method_owner_s = safe_str(method_owner)
-            ln_s = safe_str(ln)
-            val_str = "<method '%s' of %s %s:%s>" % (name_s, method_owner_s,
-                                                     filename_s, ln_s)
     else:
-        val_str= safe_repr_or_str(value)
+        cls = type(value)
+        formatter = _dispatch_cache.get(cls) or _find_formatter(cls, value)
+        val_str = formatter(value, truncation, max_depth, depth)
 
     val_str = truncate(val_str, truncation)
 
     if depth == 0:
-        val_str = wrap_lines(val_str, wrap)
-
-    if indent > 0:
+        val_str = wrap_lines(val_str, wrap, indent)
+    elif indent > 0:
         nl_indented = '\n' + (' ' * indent)
         val_str = val_str.replace('\n', nl_indented)
 
@@ -107,7 +176,8 @@ def format_dict(value, truncation, max_depth, depth):
         for k, v in value.items():
             if char_count >= truncation:
                 break
-            kstr = truncate(repr(k), MAXLEN_DICT_KEY_REPR)
+            kstr = truncate(bounded_repr(k, MAXLEN_DICT_KEY_REPR),
+                            MAXLEN_DICT_KEY_REPR)
             vstr = format_value(v, indent=len(kstr) + 3,
                                 truncation=truncation, depth=depth+1)
             istr = "%s: %s" % (kstr, vstr)
@@ -164,45 +234,212 @@ def format_iterable(value, truncation, max_depth, depth):
     return prefix + val_str + postfix
 
 
-def format_array(arr, minimize=False):
+def format_callable(value, truncation, max_depth, depth):
+    name, filepath, method_owner, ln = inspect_callable(value)
+    filename = os.path.basename(filepath) if filepath is not None else None
+    if filename is None:
+        return safe_repr(value)
+    elif method_owner is None:
+        name_s = safe_str(name)
+        filename_s = safe_str(filename)
+        ln_s = safe_str(ln)
+        return "<function '%s' %s:%s>" % (name_s, filename_s, ln_s)
+    else:
+        name_s = safe_str(name)
+        filename_s = safe_str(filename)
+        method_owner_s = safe_str(method_owner)
+        ln_s = safe_str(ln)
+        return "<method '%s' of %s %s:%s>" % (name_s, method_owner_s,
+                                             filename_s, ln_s)
+
+
+def format_repr(value, truncation, max_depth, depth):
+    return safe_repr_or_str(value)
+
+
+def format_sliceable(value, truncation, max_depth, depth):
+    return bounded_repr(value, truncation)
+
+
+def bounded_repr(value, n):
+    """
+    repr a value, or at least the first n characters of its repr
+
+    For strings & bytes, this costs O(n) instead of O(len(value)), so a 50 MB
+    buffer doesn't get copied a few times over just to show a few hundred
+    characters. (Other types get a full repr.)
+    """
+    cls = type(value)
+    if n and cls in (str, bytes, bytearray) and len(value) > n + 4:
+        # like reprlib: only repr the start. But that needs to get the same
+        # quotes that the whole thing would get, so add a quote char (which
+        # gets cut off later) to make repr pick the right ones.
+        sq, dq = ("'", '"') if cls is str else (b"'", b'"')
+        head = value[:n + 4]
+        if sq in value and dq not in value:
+            head += sq
+        else:
+            head += dq
+        return safe_repr_or_str(head)
+    return safe_repr_or_str(value)
+
+
+def _format_ndarray(value, truncation, max_depth, depth):
+    return format_array(value, minimize=depth > 0)
+
+
+def format_array(arr, minimize=False, stats=False):
     """
     format a numpy array (with shape information)
 
+    Big arrays are summarized by their corners, so this only ever reads a few
+    elements (no copies, and memory mapped arrays don't get paged in).
+
     Params
     ---
     minimize: bool
         use an extra compact oneline format
+
+    stats: bool
+        also show min, max and the number of nans. For big arrays, these are
+        estimated from a sample of ARRAY_STATS_SAMPLE elements. To get them
+        in tracebacks, register this as the formatter for arrays:
+        `register_formatter('numpy.ndarray', lambda arr, *_:
+                                                format_array(arr, stats=True))`
     """
+    import numpy as np
+
+    typename = 'array' if type(arr) is np.ndarray else type(arr).__name__
+
     if arr.ndim >= 1:
         shape = list(arr.shape)
         if len(shape) < 2:
             shape.append('')
         shape_str = "x".join(str(d) for d in shape)
         if len(shape_str) < 10:
-            prefix = "%s array(" % shape_str
+            prefix = "%s %s(" % (shape_str, typename)
             msg = prefix
         else:
             prefix = ""
-            msg = "%s array(\n" % shape_str
+            msg = "%s %s(\n" % (shape_str, typename)
     else:
-        msg = prefix = "array("
+        msg = prefix = "%s(" % typename
 
     suffix = ')'
 
-    try:
-        array_rep = np.array2string(arr, max_line_width=9000, threshold=50,
-                                    edgeitems=2, prefix=prefix, suffix=suffix)
-    except TypeError:
-        # some super old numpy versions (< 1.14) don't accept all these arguments
-        array_rep = np.array2string(arr, max_line_width=9000, prefix=prefix)
+    if minimize and arr.ndim > 1:
+        # (would be thrown away below anyway)
+        array_rep = ''
+    else:
+        try:
+            array_rep = np.array2string(arr, max_line_width=9000, threshold=50,
+                                        edgeitems=2, prefix=prefix, suffix=suffix)
+        except TypeError:
+            # some super old numpy versions (< 1.14) don't accept all these arguments
+            array_rep = np.array2string(arr, max_line_width=9000, prefix=prefix)
 
     if minimize and (len(array_rep) > 50 or arr.ndim > 1):
-        array_rep = "%s%s...%s" % ('[' * arr.ndim, arr.flatten()[0], ']' * arr.ndim)
-
+        first = arr[(0,) * arr.ndim] if arr.size else ''
+        array_rep = "%s%s...%s" % ('[' * arr.ndim, first, ']' * arr.ndim)
 
     msg += array_rep + suffix
+
+    if stats and not minimize:
+        stats_str = _array_stats(arr)
+        if stats_str:
+            msg = "%s\n%s" % (stats_str, msg)
+
     return msg
 
+
+def _array_stats(arr):
+    import numpy as np
+
+    if arr.dtype.kind not in 'iuf' or arr.size == 0:
+        return ''
+
+    sampled = arr.size > ARRAY_STATS_SAMPLE
+    if sampled:
+        # a few evenly spaced runs of elements, gathered without touching the
+        # others (contiguous runs, so only a few pages of a memmap get read)
+        n_runs = 16
+        run = ARRAY_STATS_SAMPLE // n_runs
+        starts = np.linspace(0, arr.size - run, n_runs).astype(int)
+        sample = np.concatenate([arr.flat[a:a + run] for a in starts])
+    else:
+        sample = arr
+    n_sampled = sample.size
+
+    n_nan = 0
+    if arr.dtype.kind == 'f':
+        with np.errstate(all='ignore'):
+            nans = np.isnan(sample)
+        n_nan = int(nans.sum())
+        if n_nan:
+            sample = sample[~nans]
+
+    if sample.size:
+        msg = "# min %s, max %s" % (sample.min(), sample.max())
+    else:
+        msg = "# all nan"
+    if arr.dtype.kind == 'f':
+        msg += ", %d nan" % n_nan
+    if sampled:
+        msg += " (in %d sampled elements)" % n_sampled
+    return msg
+
+
+def format_buffer(value, truncation, max_depth, depth):
+    """
+    format memoryviews, array.arrays & other things that look like arrays
+
+    With numpy around, these become array views (no copies) and get
+    formatted like arrays.
+    """
+    np = sys.modules.get('numpy')
+    typename = type(value).__name__
+    if np is not None:
+        try:
+            arr = np.asarray(value)
+        except Exception:
+            pass
+        else:
+            if arr.dtype != object:
+                return "%s %s" % (typename, format_array(arr, depth > 0))
+
+    try:
+        view = memoryview(value)
+    except Exception:
+        return safe_repr_or_str(value)
+
+    with view:
+        if view.ndim != 1 or len(view) > 4:
+            if view.ndim == 1:
+                # (only the corners, like for arrays)
+                try:
+                    items = "[%s, %s, ..., %s, %s]" % (view[0], view[1],
+                                                      view[-2], view[-1])
+                except (NotImplementedError, TypeError):
+                    # (formats memoryview can't unpack, like ctypes' '<i')
+                    items = "%d items" % len(view)
+            else:
+                items = "shape %s" % (view.shape,)
+            return "%s(%r, %s, %d bytes)" % (typename, view.format, items,
+                                             view.nbytes)
+    return safe_repr_or_str(value)
+
+
+for _cls in (list, tuple, set):
+    register_formatter(_cls, format_iterable)
+register_formatter(dict, format_dict)
+register_formatter('numpy.ndarray', _format_ndarray)
+register_formatter('numpy.generic', format_repr)  # (scalars have an __array_interface__ too)
+for _cls in (str, bytes, bytearray):
+    register_formatter(_cls, format_sliceable)
+register_formatter(memoryview, format_buffer)
+register_formatter(array.array, format_buffer)
+
+
 def safe_repr(value):
     try:
         return repr(value)
@@ -236,9 +473,14 @@ def truncate(string, n):
     return string
 
 
-def wrap_lines(string, max_width=80):
+def wrap_lines(string, max_width=80, indent=0):
+    """
+    insert linebreaks after max_width characters, and (optionally) indent all
+    lines after the first
+    """
+    nl_indented = '\n' + (' ' * indent)
     if not max_width or max_width <= 0:
-        return string
+        return string.replace('\n', nl_indented) if indent > 0 else string
 
     def wrap(lines):
         for l in lines:
@@ -256,4 +498,4 @@ def wrap_lines(string, max_width=80):
                     k += max_width
 
     wrapped_lines = wrap(string.splitlines())
-    return '\n'.join(wrapped_lines)
+    return nl_indented.join(wrapped_lines)
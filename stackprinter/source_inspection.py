@@ -1,7 +1,14 @@
+import ast
 import tokenize
 import warnings
+import itertools
+from bisect import bisect_left
+from array import array
 from keyword import kwlist
 from collections import defaultdict
+from collections.abc import Mapping
+
+from stackprinter.utils import quiet_parse
 
 RAW = 'RAW'
 COMMENT = 'COMM'
@@ -10,8 +17,16 @@ KEYWORD = 'KW'
 CALL = 'CALL'
 OP = 'OP'
 
+# compact codes for the token types, as stored in a SourceMap
+TOKEN_TYPES = [RAW, COMMENT, VAR, KEYWORD, CALL, OP]
+TYPE_CODES = {ttype: code for code, ttype in enumerate(TOKEN_TYPES)}
+
+
+ANNOTATORS = ['tokenize', 'ast']
 
-def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15):
+
+def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15,
+             annotator='tokenize'):
     """
     Find out where in a piece of code which variables live.
 
@@ -32,9 +47,19 @@ def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15):
     max_line: int
         Stop analysing after this many lines
 
+    annotator: 'tokenize' or 'ast'
+        How to find the variables. 'tokenize' runs python's tokenizer over all
+        of the source and treats every name as a variable. 'ast' gets them
+        from a syntax tree instead, which is quicker and knows e.g. that
+        keyword arguments of calls aren't variables. It only tokenizes the
+        source (for the token types in source_map) when those are first asked
+        for, which only the colorful formatters do -- so it's only quicker
+        for plain text. If the source can't be parsed on its own, it falls
+        back to 'tokenize'.
+
     Returns
     ---
-     source_map: OrderedDict
+     source_map: SourceMap
         Maps line numbers to a list of tokens. Each token is a (string, TYPE)
         tuple. Concatenating the first elements of all tokens of all lines
         restores the original source, weird whitespaces/indentations and all
@@ -55,8 +80,12 @@ def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15):
         identical to the supplied argument lineno, unless that line had to be
         moved when collapsing a backslash-continued multiline statement.
     """
+    if annotator not in ANNOTATORS:
+        raise ValueError("annotator must be one of %s, was %r" %
+                         (ANNOTATORS, annotator))
+
     if not source_lines:
-        return {}, {}, {}, [], lineno
+        return SourceMap.build([], line_offset, {}), {}, {}, [], lineno
 
     assert isinstance(line_offset, int)
     assert isinstance(lineno, int)
@@ -66,7 +95,26 @@ def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15):
     lineno += lineno_corrections[lineno - line_offset]
 
     max_line_relative = min(len(source_lines), max_line-line_offset)
-    tokens, head_s, head_e = _tokenize(source_lines[:max_line_relative])
+
+    annotation = None
+    if annotator == 'ast':
+        annotation = _annotate_ast(source_lines, line_offset,
+                                   max_line_relative, lineno_corrections)
+    if annotation is None:
+        annotation = _annotate_tokenize(source_lines, line_offset,
+                                        max_line_relative, lineno_corrections)
+
+    source_map, line2names, name2lines, head_s, head_e = annotation
+    if head_s is not None and head_e is not None:
+        head_lines = list(range(head_s + line_offset, 1 + head_e + line_offset))
+    else:
+        head_lines = []
+
+    return source_map, line2names, name2lines, head_lines, lineno
+
+
+def _annotate_tokenize(source_lines, line_offset, n_lines, lineno_corrections):
+    tokens, head_s, head_e = _tokenize(source_lines[:n_lines])
 
     tokens_by_line = defaultdict(list)
     name2lines = defaultdict(list)
@@ -78,36 +126,364 @@ def annotate(source_lines, line_offset=0, lineno=0, max_line=2**15):
             name2lines[string].append(ln)
             line2names[ln].append(string)
 
-    source_map = {}
-    for ln, line in enumerate(source_lines):
-        ln = ln + line_offset
-        regions = []
-        col = 0
-        for ttype, tok_start, tok_end, string in tokens_by_line[ln]:
-            if tok_start > col:
-                snippet = line[col:tok_start]
-                regions.append((snippet, RAW))
-                col = tok_start
-            snippet = line[tok_start:tok_end]
-            if snippet != string:
-                msg = ("Token %r doesn't match raw source %r"
-                       " in line %s: %r" % (string, snippet, ln, line))
-                warnings.warn(msg)
-            regions.append((snippet, ttype))
-            col = tok_end
-
-        if col < len(line):
-            snippet = line[col:]
-            regions.append((snippet, RAW))
-
-        source_map[ln] = regions
+    source_map = SourceMap.build(source_lines, line_offset, tokens_by_line,
+                                 lineno_corrections)
+    return source_map, line2names, name2lines, head_s, head_e
 
-    if head_s is not None and head_e is not None:
-        head_lines = list(range(head_s + line_offset, 1 + head_e + line_offset))
-    else:
-        head_lines = []
 
-    return source_map, line2names, name2lines, head_lines, lineno
+def _annotate_ast(source_lines, line_offset, n_lines, lineno_corrections):
+    """
+    Like _annotate_tokenize, but find the names in a syntax tree
+
+    Returns None if the source doesn't parse.
+    """
+    source = ''.join(source_lines[:n_lines])
+    shift = 0
+    if source[:1].isspace():
+        # an indented block (like a method), which won't parse on its own
+        source = 'if 1:\n' + source
+        shift = 1
+
+    try:
+        tree = quiet_parse(source)
+    except (SyntaxError, ValueError):
+        return None
+
+    names, first_function = _find_names(tree)
+    names.sort()
+
+    name2lines = defaultdict(list)
+    line2names = defaultdict(list)
+    for sline, scol, name in names:
+        ln = sline - 1 - shift + line_offset
+        name2lines[name].append(ln)
+        line2names[ln].append(name)
+
+    head_s = head_e = None
+    if first_function is not None:
+        head_s = first_function.lineno - 1 - shift
+        head_e = _find_head_end(source_lines, head_s)
+
+    source_map = SourceMap.build_lazy(source_lines, line_offset, n_lines,
+                                      lineno_corrections)
+    return source_map, line2names, name2lines, head_s, head_e
+
+
+def _find_names(tree):
+    """
+    Find the variables in a syntax tree
+
+    Attribute lookups like `self.foo.zup` count as one name, like in _tokenize.
+
+    Returns
+    ---
+    names: list of (line, column, name) tuples, in no particular order
+
+    first_function: the FunctionDef node that comes first in the source, or None
+    """
+    names = []
+    functions = []
+    Name, Attribute, arg = ast.Name, ast.Attribute, ast.arg
+    boring = (ast.Constant, ast.expr_context, ast.operator, ast.cmpop,
+              ast.boolop, ast.unaryop)
+    AST = ast.AST
+
+    # (a plain loop is a lot quicker than ast.NodeVisitor)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        cls = node.__class__
+        if cls is Name:
+            names.append((node.lineno, node.col_offset, node.id))
+            continue
+        elif cls is Attribute:
+            attr_path = []
+            base = node
+            while base.__class__ is Attribute:
+                attr_path.append(base.attr)
+                base = base.value
+            if base.__class__ is Name:
+                attr_path.append(base.id)
+                name = '.'.join(reversed(attr_path))
+                names.append((base.lineno, base.col_offset, name))
+            else:
+                # e.g. `f(x).y`, where only what's inside the call is of interest
+                stack.append(base)
+            continue
+        elif cls is arg:
+            names.append((node.lineno, node.col_offset, node.arg))
+        elif isinstance(node, boring):
+            continue
+        elif cls in (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef):
+            names.append((node.lineno, node.col_offset, node.name))
+            if cls is not ast.ClassDef:
+                functions.append(node)
+        elif cls in (ast.Import, ast.ImportFrom):
+            bound = [node.module] if getattr(node, 'module', None) else []
+            for alias in node.names:
+                bound.append(alias.name)
+                if alias.asname:
+                    bound.append(alias.asname)
+            names.extend((node.lineno, node.col_offset, b) for b in bound)
+            continue
+        elif cls is ast.ExceptHandler and node.name and node.type is not None:
+            position = (getattr(node.type, 'end_lineno', node.lineno),
+                        getattr(node.type, 'end_col_offset', node.col_offset))
+            names.append(position + (node.name,))
+
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if value.__class__ is list:
+                stack.extend(v for v in value if isinstance(v, AST))
+            elif isinstance(value, AST):
+                stack.append(value)
+
+    first_function = None
+    if functions:
+        first_function = min(functions,
+                             key=lambda fn: (fn.lineno, fn.col_offset))
+    return names, first_function
+
+
+def _find_head_end(source_lines, head_s):
+    """
+    Index of the line with the `)` that closes a function signature
+
+    head_s: index of the line where the signature starts
+    """
+    open_parens = 0
+    lines = itertools.islice(source_lines, head_s, None)
+    try:
+        for ttype, string, (sline, scol), _, _ in tokenize.generate_tokens(
+                lines.__next__):
+            if string == '(':
+                open_parens += 1
+            elif string == ')':
+                open_parens -= 1
+                if open_parens == 0:
+                    return head_s + sline - 1
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return None
+
+
+class SourceMap(Mapping):
+    """
+    Read-only dict {line number: list of (string, TYPE) tokens}, stored compactly
+
+    Instead of lists of tuples, this keeps one string with all the source, and
+    for each token only its start position in that string (array of 4-byte
+    ints) and its type (array of bytes). A token ends where the next one
+    starts, since the tokens of a line cover it completely. The token tuples
+    are only built on demand; `line`, `tokens` and `var_names` give access to
+    the same data without building them.
+
+    `select` gives a view of some of the lines (sharing all of the arrays),
+    optionally with some leading indentation removed from each line.
+
+    A map made by `build_lazy` starts out without any tokens, and only
+    tokenizes its source when `tokens` or `var_names` is first called.
+    """
+
+    def __init__(self, text, line_starts, line_tokens, token_starts,
+                 token_types, first_line, lines=None, dedent=0,
+                 lineno_corrections=None, pending=None):
+        self.text = text
+        self.line_starts = line_starts  # offsets into text, per line + end
+        self.line_tokens = line_tokens  # index of each line's 1st token + end
+        self.token_starts = token_starts  # offsets into text, per token + end
+        self.token_types = token_types  # TYPE_CODES, per token
+        self.first_line = first_line
+        self.n_lines = len(line_starts) - 1
+        self.lines = lines  # sorted line numbers in this view, None if all
+        self.dedent = dedent
+        # how far each line (index from first_line) was moved up when
+        # collapsing backslash continuations, see `join_broken_lines`
+        self.lineno_corrections = lineno_corrections or NO_CORRECTIONS
+        if lines is None or isinstance(lines, range):
+            self._line_set = lines
+        else:
+            self._line_set = set(lines)
+        # where to get the tokens from if we don't have them yet: a
+        # (source lines, nr of lines to tokenize) tuple, or the SourceMap
+        # this one is a view of
+        self._pending = pending
+
+    @classmethod
+    def build(cls, source_lines, line_offset, tokens_by_line,
+              lineno_corrections=None):
+        """
+        Params
+        ---
+        source_lines: list of str
+
+        line_offset: int
+            line number of source_lines[0]
+
+        tokens_by_line: dict
+            Maps line numbers to lists of (TYPE, start col, end col, string)
+
+        lineno_corrections: LinenoCorrections (optional)
+            As returned by `join_broken_lines`, kept around for reference
+        """
+        line_starts = array('I', [0])
+        line_tokens = array('I', [0])
+        token_starts = array('I')
+        token_types = array('B')
+        raw = TYPE_CODES[RAW]
+
+        offset = 0
+        for ln, line in enumerate(source_lines, line_offset):
+            col = 0
+            for ttype, tok_start, tok_end, string in tokens_by_line.get(ln, ()):
+                if tok_start > col:
+                    token_starts.append(offset + col)
+                    token_types.append(raw)
+                    col = tok_start
+                snippet = line[col:tok_end]
+                if snippet != string:
+                    msg = ("Token %r doesn't match raw source %r"
+                           " in line %s: %r" % (string, snippet, ln, line))
+                    warnings.warn(msg)
+                token_starts.append(offset + col)
+                token_types.append(TYPE_CODES[ttype])
+                col = max(col, tok_end)
+
+            if col < len(line):
+                token_starts.append(offset + col)
+                token_types.append(raw)
+
+            offset += len(line)
+            line_starts.append(offset)
+            line_tokens.append(len(token_starts))
+
+        token_starts.append(offset)
+        return cls(''.join(source_lines), line_starts, line_tokens,
+                   token_starts, token_types, line_offset,
+                   lineno_corrections=lineno_corrections)
+
+    @classmethod
+    def build_lazy(cls, source_lines, line_offset, n_tokenized,
+                   lineno_corrections=None):
+        """
+        Like `build`, but leave the tokenizing for later
+
+        n_tokenized: int
+            how many of the source lines to tokenize when it comes to that
+            (the rest will be one RAW token per line)
+        """
+        line_starts = array('I', [0])
+        line_starts.extend(itertools.accumulate(map(len, source_lines)))
+        return cls(''.join(source_lines), line_starts, None, None, None,
+                   line_offset, lineno_corrections=lineno_corrections,
+                   pending=(source_lines, n_tokenized))
+
+    def select(self, lines, dedent=0):
+        """
+        Get a view of only some lines, with `dedent` characters of indentation
+        removed from each (except from empty lines)
+
+        lines: sorted list or range of line numbers
+        """
+        pending = self if self._pending is not None else None
+        return SourceMap(self.text, self.line_starts, self.line_tokens,
+                         self.token_starts, self.token_types, self.first_line,
+                         lines, dedent, self.lineno_corrections, pending)
+
+    def bounds(self):
+        """
+        First and last line number, or (0, 0) if there are no lines
+        """
+        if not len(self):
+            return 0, 0
+        elif self.lines is None:
+            return self.first_line, self.first_line + self.n_lines - 1
+        else:
+            return self.lines[0], self.lines[-1]
+
+    def line(self, ln):
+        """
+        The source of a line, as a string
+        """
+        k = self._index(ln)
+        text = self.text[self.line_starts[k]:self.line_starts[k+1]]
+        if self.dedent and not text.startswith('\n'):
+            text = text[self.dedent:]
+        return text
+
+    def tokens(self, ln):
+        """
+        Iterate over (string, TYPE) tuples of a line
+        """
+        k = self._index(ln)
+        if self._pending is not None:
+            self._load_tokens()
+        text = self.text
+        starts = self.token_starts
+        types = self.token_types
+        first, last = self.line_tokens[k], self.line_tokens[k+1]
+        for t in range(first, last):
+            start = starts[t]
+            snippet = text[start:starts[t+1]]
+            if t == first and self.dedent and not snippet.startswith('\n'):
+                snippet = snippet[self.dedent:]
+            yield snippet, TOKEN_TYPES[types[t]]
+
+    def var_names(self, ln):
+        """
+        Iterate over the variable names in a line
+        """
+        k = self._index(ln)
+        if self._pending is not None:
+            self._load_tokens()
+        text = self.text
+        starts = self.token_starts
+        types = self.token_types
+        var = TYPE_CODES[VAR]
+        for t in range(self.line_tokens[k], self.line_tokens[k+1]):
+            if types[t] == var:
+                yield text[starts[t]:starts[t+1]]
+
+    def _load_tokens(self):
+        pending = self._pending
+        if pending is None:
+            return
+        elif isinstance(pending, SourceMap):
+            pending._load_tokens()
+            tokenized = pending
+        else:
+            source_lines, n_tokenized = pending
+            tokenized, *_ = _annotate_tokenize(source_lines, self.first_line,
+                                               n_tokenized, None)
+        self.line_tokens = tokenized.line_tokens
+        self.token_starts = tokenized.token_starts
+        self.token_types = tokenized.token_types
+        self._pending = None
+
+    def _index(self, ln):
+        k = ln - self.first_line
+        if not 0 <= k < self.n_lines or (self._line_set is not None and
+                                         ln not in self._line_set):
+            raise KeyError(ln)
+        return k
+
+    def __getitem__(self, ln):
+        return list(self.tokens(ln))
+
+    def __contains__(self, ln):
+        try:
+            self._index(ln)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        if self.lines is None:
+            return iter(range(self.first_line, self.first_line + self.n_lines))
+        return iter(self.lines)
+
+    def __len__(self):
+        return self.n_lines if self.lines is None else len(self.lines)
 
 
 def _tokenize(source_lines):
@@ -211,14 +587,33 @@ def _tokenize(source_lines):
 def join_broken_lines(source_lines):
     """
     Collapse backslash-continued lines into the first (upper) line
+
+    Returns
+    ---
+    unbroken_lines: list of str
+        The same number of lines, with every continued line merged into the
+        line above and replaced by a blank line. If there was nothing to
+        collapse, this is just `source_lines` itself.
+
+    lineno_corrections: LinenoCorrections
+        How far each line index moved up, 0 for most of them.
     """
 
     # TODO meditate whether this is a good idea
 
+    # almost no code has backslash continuations these days, so check for
+    # them before doing any actual work
+    for first_broken, line in enumerate(source_lines):
+        if line.endswith('\\\n'):
+            break
+    else:
+        return source_lines, NO_CORRECTIONS
+
     n_lines = len(source_lines)
-    unbroken_lines = []
-    k = 0
-    lineno_corrections = defaultdict(lambda: 0)
+    unbroken_lines = source_lines[:first_broken]
+    corrected_lines = array('I')
+    corrections = array('i')
+    k = first_broken
     while k < n_lines:
         line = source_lines[k]
 
@@ -240,12 +635,37 @@ def join_broken_lines(source_lines):
                 indent = white_char * max(0, (n_raw - n_stripped - fudge))
 
             gobbled_lines.append(indent + "\n" )
-            lineno_corrections[k] = k_continued - k
+            corrected_lines.append(k)
+            corrections.append(k_continued - k)
 
         unbroken_lines.append(line)
         unbroken_lines.extend(gobbled_lines)
         k += 1
 
-    return unbroken_lines, lineno_corrections
+    return unbroken_lines, LinenoCorrections(corrected_lines, corrections)
+
+
+class LinenoCorrections():
+    """
+    Read-only sparse dict {line index: correction}, which is 0 for unlisted keys
+
+    lines: sorted array of line indices
+    corrections: array of the corresponding corrections
+    """
+    __slots__ = ('lines', 'corrections')
+
+    def __init__(self, lines, corrections):
+        self.lines = lines
+        self.corrections = corrections
+
+    def __getitem__(self, k):
+        i = bisect_left(self.lines, k)
+        if i < len(self.lines) and self.lines[i] == k:
+            return self.corrections[i]
+        return 0
+
+    def __len__(self):
+        return len(self.lines)
 
 
+NO_CORRECTIONS = LinenoCorrections(array('I'), array('i'))
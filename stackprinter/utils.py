@@ -1,8 +1,10 @@
 import re
+import ast
 import types
-import inspect
+import weakref
 import colorsys
-from collections import OrderedDict
+import warnings
+import functools
 
 
 def match(string, patterns):
@@ -14,6 +16,40 @@ def match(string, patterns):
     return any(map(lambda p: re.search(p, string), patterns))
 
 
+def quiet_parse(source, filename='<unknown>', compile_code=False):
+    """
+    ast.parse (or compile, for a code object) without any warnings
+
+    Parsing someone else's code can warn e.g. about invalid escape sequences
+    in it -- not our business.
+
+    Raises SyntaxError or ValueError if the source doesn't parse.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if compile_code:
+            return compile(source, filename, 'exec', dont_inherit=True)
+        return ast.parse(source, filename)
+
+
+def path_matcher(patterns):
+    """
+    Get a function that tells if a path matches any of some regex patterns
+
+    Like `match`, but it remembers the answer for each path.
+    """
+    known = {}
+    def matches(path):
+        try:
+            return known[path]
+        except KeyError:
+            is_match = known[path] = match(path, patterns)
+            return is_match
+    return matches
+
+
+_callable_info = weakref.WeakKeyDictionary()
+
 def inspect_callable(f):
     """
     Find out to which object & file a function belongs
@@ -22,22 +58,27 @@ def inspect_callable(f):
 
     owner = getattr(f, '__self__', None)
 
-    if inspect.ismethod(f):
+    if isinstance(f, types.MethodType):
         f = f.__func__
 
-    if inspect.isfunction(f):
-        code = f.__code__
+    if not isinstance(f, types.FunctionType):
     # elif isinstance(f, types.BuiltinFunctionType):
     # ?
-    else:
         return None, None, None, None
 
-    qname = getattr(f, '__qualname__', None)
+    # the same functions (e.g. methods of `self`) tend to come up again and
+    # again in a traceback, so remember what we found out about each.
+    try:
+        qname, filepath, ln = _callable_info[f]
+    except KeyError:
+        code = f.__code__
+        qname = getattr(f, '__qualname__', None)
 
-    # under pypy, builtin code object (like: [].append.__func__.__code__)
-    # have no co_filename and co_firstlineno
-    filepath = getattr(code, 'co_filename', None)
-    ln = getattr(code, 'co_firstlineno', None)
+        # under pypy, builtin code object (like: [].append.__func__.__code__)
+        # have no co_filename and co_firstlineno
+        filepath = getattr(code, 'co_filename', None)
+        ln = getattr(code, 'co_firstlineno', None)
+        _callable_info[f] = qname, filepath, ln
 
     return qname, filepath, owner, ln
 
@@ -50,38 +91,50 @@ def trim_source(source_map, context):
     indent_type = None
     min_indent = 9000
     for ln in context:
-        (snippet0, *meta0), *remaining_line = source_map[ln]
+        line = source_map.line(ln)
 
-        if snippet0.startswith('\t'):
+        if line.startswith('\t'):
             if indent_type == ' ':
                 # Mixed tabs and spaces - not trimming whitespace.
-                return source_map
+                return source_map.select(context)
             else:
                 indent_type = '\t'
-        elif snippet0.startswith(' '):
+        elif line.startswith(' '):
             if indent_type == '\t':
                 # Mixed tabs and spaces - not trimming whitespace.
-                return source_map
+                return source_map.select(context)
             else:
                 indent_type = ' '
-        elif snippet0.startswith('\n'):
+        elif line.startswith('\n'):
             continue
 
-        n_nonwhite = len(snippet0.lstrip(' \t'))
-        indent = len(snippet0) - n_nonwhite
+        n_nonwhite = len(line.lstrip(' \t'))
+        indent = len(line) - n_nonwhite
         min_indent = min(indent, min_indent)
 
-    trimmed_source_map = OrderedDict()
-    for ln in context:
-        (snippet0, *meta0), *remaining_line = source_map[ln]
-        if not snippet0.startswith('\n'):
-            snippet0 = snippet0[min_indent:]
-        trimmed_source_map[ln] = [[snippet0] + meta0] + remaining_line
+    return source_map.select(context, dedent=min_indent)
 
-    return trimmed_source_map
 
 
+def merge_line_ranges(head, lines):
+    """
+    Combine two sorted, gap-free lists (or ranges) of line numbers
+
+    Returns a range if the result has no gaps, otherwise a sorted list
+    """
+    if not head:
+        return lines
+    h0, h1 = head[0], head[-1]
+    l0, l1 = lines[0], lines[-1]
+    if h1 + 1 >= l0 and l1 + 1 >= h0:
+        return range(min(h0, l0), max(h1, l1) + 1)
+    elif h1 < l0:
+        return list(head) + list(lines)
+    else:
+        return list(lines) + list(head)
+
 
+@functools.lru_cache(maxsize=512)
 def get_ansi_tpl(hue, sat, val, bold=False):
 
     # r_, g_, b_ = colorsys.hls_to_rgb(hue, val, sat)
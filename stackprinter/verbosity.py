@@ -0,0 +1,143 @@
+"""
+Decide how much to show of each frame, before looking at it in any detail
+"""
+import types
+from collections import namedtuple
+
+from stackprinter.utils import path_matcher
+
+VERBOSE = 'verbose'  # source & variables, as configured by `source_lines` etc
+BORING = 'boring'    # the first of several boring frames in a row is REDUCED,
+                     # the others MINIMAL (what `suppressed_paths` does)
+REDUCED = 'reduced'  # 1 line of source, with the variables in it
+MINIMAL = 'minimal'  # 1 line of source, no variables
+LINE = 'line'        # like MINIMAL, but straight from the code object & linecache,
+                     # without extracting anything else from the frame
+HIDDEN = 'hidden'    # not shown at all (and not looked at), just counted
+
+LEVELS = [VERBOSE, BORING, REDUCED, MINIMAL, LINE, HIDDEN]
+
+# stand-in for code objects, for frames that come already extracted
+CodeInfo = namedtuple('CodeInfo', ['co_filename', 'co_name'])
+
+
+class VerbosityPolicy():
+
+    def __init__(self, rules=(), default=VERBOSE):
+        """
+        Pick a verbosity level for frames, based on the code they run
+
+        Like the formatters, this is a partially applied function: configure
+        it here, then call it with code objects. The answer for each code
+        object is remembered, so this works out once per function, no matter
+        how many frames are running it.
+
+        For fancier decisions, subclass this and override `level`.
+
+        Params
+        ---
+        rules: list of (regex pattern, level) tuples
+            The first pattern that matches a code's file path decides its
+            level. Levels are VERBOSE, BORING, REDUCED, MINIMAL, LINE or HIDDEN
+            (see LEVELS), or a FrameFormatter to use for those frames.
+
+        default: level or None
+            For code that matches none of the patterns. Default: VERBOSE
+            None means no opinion: `suppressed_paths` decide then, if this is
+            used as `verbosity` in stackprinter.format() (and otherwise it's
+            VERBOSE, too).
+        """
+        for _, level in rules:
+            _check_level(level)
+        if default is not None:
+            _check_level(default)
+
+        self.rules = [(path_matcher([pattern]), level) for pattern, level in rules]
+        self.default = default
+        self._levels = {}
+
+    def __call__(self, code):
+        if not isinstance(code, types.CodeType):
+            return self._decide(code)
+
+        known = self._levels.get(id(code))
+        if known is not None and known[0] is code:
+            return known[1]
+
+        level = self._decide(code)
+        if len(self._levels) > 10000:
+            self._levels.clear()
+        self._levels[id(code)] = (code, level)
+        return level
+
+    def _decide(self, code):
+        level = self.level(code)
+        return VERBOSE if level is None else _check_level(level)
+
+    def level(self, code):
+        """
+        Returns the level for frames running a code object, or None for no
+        opinion
+
+        code: code object (or CodeInfo, with just co_filename and co_name)
+        """
+        for matches, level in self.rules:
+            if matches(code.co_filename):
+                return level
+        return self.default
+
+
+class FunctionPolicy(VerbosityPolicy):
+
+    def __init__(self, func, fallback=None):
+        """
+        A policy that asks a function (code -> level) once per code object
+
+        fallback: VerbosityPolicy (optional)
+            Decides where the function returns None.
+        """
+        super().__init__()
+        self.func = func
+        self.fallback = fallback
+
+    def level(self, code):
+        level = self.func(code)
+        if level is None and self.fallback is not None:
+            level = self.fallback.level(code)
+        return level
+
+
+def get_policy(verbosity=None, suppressed_paths=None, suppressed_level=BORING):
+    """
+    Make a policy out of the `verbosity` kwarg of stackprinter.format()
+
+    verbosity: None, list of (pattern, level) rules, function or VerbosityPolicy
+        Rules also get one more rule at the end, which gives suppressed_paths
+        the `suppressed_level`. By default, that's the only rule. Functions
+        and policies get that rule as a fallback, for code where they return
+        None.
+    """
+    if isinstance(suppressed_paths, str):
+        suppressed_paths = [suppressed_paths]
+    suppressed_rules = [(pattern, suppressed_level)
+                        for pattern in suppressed_paths or []]
+
+    if isinstance(verbosity, VerbosityPolicy) and not suppressed_rules:
+        return verbosity
+    elif callable(verbosity):
+        if isinstance(verbosity, VerbosityPolicy):
+            # (its uncached answer, the new policy caches it anyway)
+            func = verbosity.level
+        else:
+            func = verbosity
+        return FunctionPolicy(func, VerbosityPolicy(suppressed_rules,
+                                                    default=None))
+
+    return VerbosityPolicy(list(verbosity or []) + suppressed_rules)
+
+
+def _check_level(level):
+    if level not in LEVELS and not callable(level):
+        raise ValueError("Verbosity level must be one of %s or a formatter, "
+                         "was %r" % (LEVELS, level))
+    return level
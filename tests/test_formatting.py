@@ -88,3 +88,475 @@ def test_tb_with_none_lineno():
     output = stackprinter.format((ValueError, ValueError("boom"), tb))
     assert "target" in output
     assert "ValueError: boom" in output
+
+
+def test_task_formatting():
+    import asyncio
+
+    async def inner(n):
+        x = n * 2
+        await asyncio.sleep(10)
+
+    async def outer(n):
+        await inner(n)
+
+    async def main():
+        tasks = [asyncio.create_task(outer(n)) for n in range(20)]
+        await asyncio.sleep(0)
+        msg_task = stackprinter.format(tasks[3])
+        msg_all = stackprinter.format_all_tasks()
+        for task in tasks:
+            task.cancel()
+        return msg_task, msg_all
+
+    msg_task, msg_all = asyncio.run(main())
+
+    assert 'in outer' in msg_task
+    assert 'in inner' in msg_task
+    assert 'x = 6' in msg_task
+    assert msg_all.count('in inner') == 1
+    assert '(+ 19 more tasks with the same await chain)' in msg_all
+
+
+def test_exception_group_formatting():
+    import re
+    import sys
+    import pytest
+    if sys.version_info < (3, 11):
+        pytest.skip("exception groups are new in python 3.11")
+
+    def fail(n):
+        raise ValueError(n)
+
+    def collect():
+        errors = []
+        for n in range(3):
+            try:
+                fail(n)
+            except ValueError as e:
+                errors.append(e)
+        errors.append(ExceptionGroup('inner', [KeyError('k')]))
+        raise ExceptionGroup('outer', errors)
+
+    try:
+        collect()
+    except Exception as e:
+        msg = stackprinter.format(e)
+
+    assert 'ExceptionGroup: outer (4 sub-exceptions)' in msg
+    assert '3 sub-exceptions, all sharing these frames' in msg
+    # the shared `fail(n)` call site is shown once, not once per member
+    assert len(re.findall(r'--> \d+ +fail\(n\)', msg)) == 1
+    assert msg.count('in fail') == 3
+    assert '    ValueError: 2' in msg
+    assert '        KeyError: ' in msg
+
+
+def test_long_and_cyclic_exception_chains():
+    import sys
+
+    exc = None
+    for k in range(sys.getrecursionlimit() + 100):
+        try:
+            raise RuntimeError('retry %d' % k) from exc
+        except RuntimeError as e:
+            exc = e
+
+    msg = stackprinter.format(exc, max_chain_length=3)
+    assert msg.startswith('(%d earlier exceptions' % (k + 1 - 3))
+    assert msg.count('RuntimeError: retry') == 3
+    assert msg.endswith('RuntimeError: retry %d' % k)
+
+    a, b = ValueError('a'), KeyError('b')
+    a.__context__, b.__context__ = b, a
+    output = stackprinter.format(a)
+    assert output == ("KeyError: 'b'\n\nWhile handling the above exception, "
+                      "another exception occurred:\n\nValueError: a")
+
+
+def test_add_summary():
+    import sys
+    from stackprinter.formatting import format_summary
+
+    def recurse(n):
+        if n == 0:
+            raise ValueError('bottom')
+        recurse(n - 1)
+
+    try:
+        recurse(3)
+    except ValueError:
+        etype, evalue, tb = sys.exc_info()
+
+    frames = []
+    while tb:
+        frames.append(tb)
+        tb = tb.tb_next
+    summary = format_summary(frames)
+
+    msg_short = stackprinter.format(evalue, add_summary='auto', source_lines=1)
+    assert 'full traceback above' not in msg_short
+
+    for add_summary in [True, 'auto']:
+        msg = stackprinter.format(evalue, add_summary=add_summary,
+                                  source_lines='all', show_vals='all')
+        assert msg.endswith('---- (full traceback above) ----\n' +
+                            summary + '\nValueError: bottom')
+
+
+def test_parallel_rendering():
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+
+    def recurse(n):
+        some_list = [n] * 3
+        a, b, c = object(), object(), object()
+        if n == 0:
+            raise ValueError('bottom')
+        recurse(n - 1)
+
+    try:
+        recurse(20)
+    except ValueError as e:
+        # (leave out this frame, its variables keep changing below)
+        exc_info = (ValueError, e, e.__traceback__.tb_next)
+
+    # (switch threads often, so any dependence on the order in which the
+    # workers get to each frame, like in the choice of colors, shows up)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for style in ['plaintext', 'darkbg', 'darkbg2'] * 5:
+            msg = stackprinter.format(exc_info, style=style, source_lines='all')
+            msg_threads = stackprinter.format(exc_info, style=style,
+                                              source_lines='all',
+                                              executor='thread')
+            assert msg_threads == msg
+    finally:
+        sys.setswitchinterval(interval)
+
+    with ProcessPoolExecutor(2) as pool:
+        msg_processes = stackprinter.format(exc_info, source_lines='all',
+                                            executor=pool)
+        assert msg_processes == stackprinter.format(exc_info, source_lines='all')
+
+        # source that the (already running) workers can't find
+        import linecache
+        source = "def generated(x):\n    return 1 / x\n"
+        linecache.cache['<generated>'] = (len(source), None,
+                                          source.splitlines(True), '<generated>')
+        namespace = {}
+        exec(compile(source, '<generated>', 'exec'), namespace)
+        try:
+            namespace['generated'](0)
+        except ZeroDivisionError as e:
+            exc = e
+        msg = stackprinter.format(exc, executor=pool)
+        assert msg == stackprinter.format(exc)
+        assert 'return 1 / x' in msg
+
+
+def test_variable_colors_are_distinct():
+    from stackprinter.colorschemes import darkbg2, get_palette
+
+    scheme = darkbg2()
+    palette = get_palette(scheme.hue_range, 1., 0.8)
+    seeds = ['var_%d' % k for k in range(len(palette))]
+    hues = [scheme.get_random(seed, False)[0] for seed in seeds]
+    assert sorted(hues) == sorted(palette)
+
+    # ...and stable once picked
+    assert [scheme.get_random(seed, True)[0] for seed in seeds] == hues
+
+
+def test_warmup(tmp_path):
+    from stackprinter.annotation_store import default_store
+    from source import Hovercraft
+    import source
+
+    try:
+        Hovercraft().eels
+    except Exception as exc:
+        cold = stackprinter.format(exc)
+
+        saved = str(tmp_path / 'annotations.pickle')
+        stackprinter.warmup(paths=[source.__file__], background=False,
+                            save=saved)
+        try:
+            assert len(default_store) > 0
+            assert stackprinter.format(exc) == cold
+
+            default_store.clear()
+            stackprinter.warmup(background=False, load=saved)
+            assert len(default_store) > 0
+            code = Hovercraft.eels.fget.__code__
+            assert default_store._sources[(code.co_filename,
+                                           code.co_firstlineno)]
+            assert stackprinter.format(exc) == cold
+        finally:
+            default_store.clear()
+
+
+def test_lazy_import():
+    import subprocess
+    import sys
+    code = ("import sys, stackprinter; "
+            "assert 'numpy' not in sys.modules; "
+            "assert 'stackprinter.formatting' not in sys.modules; "
+            "assert stackprinter.colorschemes.darkbg; "
+            "assert stackprinter.trace is stackprinter.tracing.trace; "
+            "stackprinter.format(sys._getframe()); "
+            "assert 'numpy' not in sys.modules")
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_dedupe_vals():
+    def outer(config):
+        return inner(config)
+
+    def inner(config):
+        same = config
+        raise ValueError()
+
+    try:
+        outer({'key_%d' % k: k for k in range(30)})
+    except ValueError as e:
+        exc = e
+
+    plain = stackprinter.format(exc)
+    assert plain.count("'key_29': 29") == 3
+
+    msg = stackprinter.format(exc, dedupe_vals=True)
+    assert msg.count("'key_29': 29") == 1
+    assert "config = <same as config in outer, line " in msg
+    assert "same = <same as config in outer, line " in msg
+
+
+def test_detach():
+    import gc
+    import pickle
+    import weakref
+
+    class Big():
+        pass
+
+    def inner(blob):
+        blob.data = bytes(10**6)
+        raise ValueError('oops')
+
+    try:
+        inner(Big())
+    except ValueError as e:
+        exc = e
+
+    blob_ref = weakref.ref(exc.__traceback__.tb_next.tb_frame.f_locals['blob'])
+    before = stackprinter.format(exc)
+
+    assert stackprinter.detach(exc) is exc
+    gc.collect()
+    assert blob_ref() is None
+    assert exc.__traceback__ is None
+    assert stackprinter.format(exc) == before
+
+    unpickled = pickle.loads(pickle.dumps(exc))
+    assert stackprinter.format(unpickled) == before
+
+
+def test_detach_suspended_generators():
+    import asyncio
+
+    # an exception saved by a generator that's still going
+    def retrying():
+        try:
+            raise ValueError('first try')
+        except ValueError as e:
+            yield e
+        yield 'second try'
+
+    gen = retrying()
+    exc = next(gen)
+    stackprinter.detach(exc)
+    assert 'in retrying' in stackprinter.format(exc)
+    assert list(gen) == ['second try']
+
+    # ...same for coroutines
+    async def worker(errors, go_on):
+        try:
+            raise ValueError('oops')
+        except ValueError as e:
+            errors.append(e)
+        await go_on.wait()
+        return 'done'
+
+    async def main():
+        errors, go_on = [], asyncio.Event()
+        task = asyncio.create_task(worker(errors, go_on))
+        await asyncio.sleep(0)
+        stackprinter.detach(errors[0])
+        go_on.set()
+        return await asyncio.wait_for(task, 5)
+
+    assert asyncio.run(main()) == 'done'
+
+
+def _fail_in_worker(x):
+    secret_of_the_worker = x * 2
+    try:
+        return 1 / 0
+    except ZeroDivisionError:
+        raise ValueError(secret_of_the_worker)
+
+
+def test_detaching_in_worker_process():
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(1) as pool:
+        future = pool.submit(stackprinter.detaching(_fail_in_worker), 21)
+        try:
+            future.result()
+        except ValueError as e:
+            msg = stackprinter.format(e)
+
+    assert 'in _fail_in_worker' in msg
+    assert 'secret_of_the_worker = 42' in msg
+    assert 'ZeroDivisionError: division by zero' in msg
+    assert 'While handling the above exception' in msg
+    assert '_DetachingCall' not in msg
+
+
+def test_max_frames():
+    def recurse(n):
+        if n == 0:
+            raise ValueError('deep')
+        return recurse(n - 1)
+
+    try:
+        recurse(50)
+    except ValueError as e:
+        exc = e
+
+    msg = stackprinter.format(exc, max_frames=4, add_summary=True)
+    assert msg.count("(48 frames not shown)\n") == 2
+    assert msg.count("in recurse\n") == 2 * 3
+    assert msg.index('in test_max_frames') < msg.index('not shown')
+
+    msg = stackprinter.format(exc, tail_frames=1)
+    assert msg.startswith("(51 frames not shown)\n\nFile")
+    assert msg.count("in recurse\n") == 1
+
+    # max_frames is a hard limit
+    msg = stackprinter.format(exc, max_frames=5, head_frames=10,
+                              add_summary=False)
+    assert msg.count("in recurse\n") == 4
+    assert "(47 frames not shown)" in msg
+    msg = stackprinter.format(exc, max_frames=1, head_frames=2, tail_frames=2,
+                              add_summary=False)
+    assert msg.count("\nFile ") + msg.startswith("File ") == 1
+
+    from stackprinter.formatting import frame_window
+    assert frame_window(5, 10) == (5, 0)
+    assert frame_window(1, 2, 2) == (1, 0)
+    assert frame_window(6, 2, 2) == (2, 2)
+    assert frame_window(4, None, 3) == (1, 3)
+
+
+def test_verbosity():
+    from stackprinter.formatting import _common_location
+    here = _common_location([__file__])
+
+    def recurse(n):
+        if n == 0:
+            raise ValueError('deep')
+        return recurse(n - 1)
+
+    try:
+        recurse(5)
+    except ValueError as e:
+        exc = e
+
+    msg = stackprinter.format(exc, verbosity=[(__file__, 'hidden')])
+    assert msg.startswith("(7 frames in %s hidden)\n" % here)
+    assert 'recurse' not in msg
+
+    # frames on the 'line' level aren't analysed, but look like 'minimal' ones
+    minimal = stackprinter.format(exc, verbosity=[(__file__, 'minimal')])
+    line = stackprinter.format(exc, suppressed_paths=[__file__],
+                               suppressed_level='line')
+    assert line == minimal
+    assert line.count("in recurse\n    return recurse(n - 1)\n") == 5
+
+    # the policy is asked once per code object, not per frame
+    asked = []
+    def policy(code):
+        asked.append(code.co_name)
+        return 'minimal' if code.co_name == 'recurse' else 'verbose'
+
+    msg = stackprinter.format(exc, verbosity=policy)
+    assert sorted(asked) == ['recurse', 'test_verbosity']
+    assert msg.count("in recurse\n") == 6
+    assert "n = " not in msg
+
+    import pytest
+    with pytest.raises(ValueError):
+        stackprinter.format(exc, verbosity=[('.*', 'loud')])
+
+    # functions can leave the decision to suppressed_paths
+    def policy(code):
+        return 'verbose' if code.co_name == 'test_verbosity' else None
+
+    msg = stackprinter.format(exc, verbosity=policy,
+                              suppressed_paths=[__file__],
+                              suppressed_level='hidden')
+    assert 'in test_verbosity' in msg
+    assert "(6 frames in %s hidden)" % here in msg
+
+    from stackprinter.verbosity import VerbosityPolicy
+    policy = VerbosityPolicy([('no such file', 'minimal')], default=None)
+    msg = stackprinter.format(exc, verbosity=policy,
+                              suppressed_paths=[__file__],
+                              suppressed_level='hidden')
+    assert msg.startswith("(7 frames in %s hidden)" % here)
+
+
+def test_verbosity_with_max_frames():
+    from stackprinter.formatting import _common_location
+    here = _common_location([__file__])
+
+    def hideme(n):
+        return recurse(n - 1)
+
+    def recurse(n):
+        if n == 0:
+            raise ValueError('deep')
+        return hideme(n)
+
+    try:
+        recurse(10)
+    except ValueError as e:
+        exc = e
+
+    # runs of hidden frames end where the skipped frames are
+    policy = lambda code: 'hidden' if code.co_name == 'hideme' else 'minimal'
+    msg = stackprinter.format(exc, verbosity=policy, head_frames=3,
+                              tail_frames=2, add_summary=True)
+    stack, summary = msg.split('---- (full traceback above) ----\n')
+    for part in [stack, summary]:
+        lines = [l for l in part.split('\n') if l.startswith('(')]
+        assert lines == ["(1 frames in %s hidden)" % here,
+                         "(17 frames not shown)",
+                         "(1 frames in %s hidden)" % here]
+
+
+def test_hidden_frames_label(monkeypatch):
+    import os
+    from stackprinter.formatting import _common_location
+
+    site = os.path.join(os.sep, 'usr', 'lib', 'python3', 'site-packages')
+    monkeypatch.setattr('sys.path', [os.path.dirname(site), site])
+    models = os.path.join(site, 'django', 'db', 'models')
+    files = [os.path.join(models, 'base.py'),
+             os.path.join(models, 'query.py')]
+    assert _common_location(files) == os.path.join('django', 'db', 'models')
+    assert _common_location(files[:1]) == os.path.join('django', 'db',
+                                                       'models', 'base.py')
+    assert _common_location([files[0], __file__]) is None
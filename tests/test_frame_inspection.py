@@ -1,4 +1,5 @@
 import sys
+import dis
 import pytest
 import stackprinter.extraction as ex
 
@@ -23,3 +24,39 @@ def test_frameinfo(frameinfo):
     assert fi.assignments['somevalue'] == 'spam'
     assert isinstance(fi.assignments['supersecretthings'], ex.CensoredVariable)
     assert isinstance(fi.assignments['someobject.secretattribute'], ex.CensoredVariable)
+
+
+def test_names_in_lines(frameinfo):
+    fi = frameinfo
+    first, last = fi.line_bounds
+    everything = fi.names_in_lines(range(first, last + 1))
+    assert everything == list(fi.name2lines)
+
+    ln = fi.name2lines['somevalue'][0]
+    assert fi.names_in_lines([ln]) == ['somevalue']
+    assert fi.names_in_lines(range(ln, last + 1))[0] == 'somevalue'
+
+
+def test_find_statement_window():
+    lines = ['import os\n',
+             'x = [\n',
+             '    os,\n',
+             '    2]\n',
+             '"""\n',
+             'y = 3\n',
+             '"""\n',
+             '@decorated\n',
+             'def f():\n',
+             '    return x\n',
+             'z = 1\n']
+    code = compile(''.join(lines), 'test', 'exec')
+    code_lines = {ln for _, ln in dis.findlinestarts(code)}
+
+    # `os,` is inside a list, and `def` belongs to its decorator
+    assert ex.find_statement_window(lines, 3, 0, 0, code_lines) == (1, 4)
+    assert ex.find_statement_window(lines, 9, 0, 0, code_lines) == (7, 10)
+    assert ex.find_statement_window(lines, 11, 1, 0, code_lines) == (7, 11)
+    assert ex.find_statement_window(lines, 3, 10, 10, code_lines) is None
+
+    # `y = 3` looks like a statement, but it's inside a string
+    assert ex.find_statement_window(lines, 6, 0, 0, code_lines) == (4, 7)
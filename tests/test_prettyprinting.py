@@ -0,0 +1,77 @@
+import sys
+import pytest
+
+import stackprinter
+from stackprinter.prettyprinting import (format_value, format_array,
+                                        bounded_repr, truncate)
+
+
+def test_register_formatter():
+    class Heavy():
+        def __repr__(self):
+            raise AssertionError("shouldn't be called")
+
+    class Heavier(Heavy):
+        pass
+
+    @stackprinter.register_formatter(Heavy)
+    def format_heavy(value, truncation, max_depth, depth):
+        return "<%s>" % type(value).__name__
+
+    assert format_value(Heavy()) == "<Heavy>"
+    assert format_value([Heavier()], truncation=100) == "[<Heavier>, ]"
+
+    class Named():
+        pass
+
+    name = '%s.%s' % (__name__, Named.__qualname__)
+    stackprinter.register_formatter(name, lambda *args: "named")
+    assert format_value({"a": Named()}, truncation=100) == "{'a': named}"
+
+    # public names work too, not just where a type is defined
+    import json
+    assert json.JSONDecoder.__module__ == 'json.decoder'
+
+    class Decoder(json.JSONDecoder):
+        pass
+
+    stackprinter.register_formatter('json.JSONDecoder', lambda *args: "decoder")
+    assert format_value(Decoder()) == "decoder"
+
+
+def test_array_formatting(monkeypatch):
+    import ctypes
+
+    # without numpy, buffers get summarized via memoryview -- which can't
+    # read the items of some formats
+    with monkeypatch.context() as m:
+        m.delitem(sys.modules, 'numpy', raising=False)
+        assert (format_value(memoryview((ctypes.c_int * 10)())) ==
+                "memoryview('<i', 10 items, 40 bytes)")
+        assert (format_value(memoryview(bytes(10))) ==
+                "memoryview('B', [0, 0, ..., 0, 0], 10 bytes)")
+
+    np = pytest.importorskip('numpy')
+
+    # a view that pretends to hold 10^12 elements -- so, nothing may copy it
+    huge = np.broadcast_to(np.float64(1), (10**4, 10**4, 10**4))
+    assert format_value([huge], truncation=100) == "[\n 10000x10000x10000 array(\n [[[1.0...]]]), ]"
+    msg = format_array(huge, stats=True)
+    assert msg.startswith("# min 1.0, max 1.0, 0 nan (in 10000 sampled elements)\n")
+
+    assert format_value(np.float64(1)) == repr(np.float64(1))
+    assert format_value(memoryview(bytes(10))) == "memoryview 10x array([0 0 0 0 0 0 0 0 0 0])"
+
+
+def test_bounded_repr():
+    for value in ["it's" * 100, 'say "hi"' * 100, b"'\"\\\x00" * 100,
+                  bytearray(b"it's") * 100]:
+        for n in [1, 5, 10]:
+            assert truncate(bounded_repr(value, n), n) == truncate(repr(value), n)
+
+    class Custom(str):
+        def __repr__(self):
+            return 'custom'
+
+    assert format_value(Custom('x' * 100), truncation=10) == 'custom'
+    assert format_value('x' * 10**7, truncation=10) == "'xxxxxxxxx..."
@@ -1,11 +1,13 @@
+import pytest
 from source import sourcelines
 from stackprinter import source_inspection as si
 
 
-def test_source_annotation(sourcelines):
+@pytest.mark.parametrize('annotator', si.ANNOTATORS)
+def test_source_annotation(sourcelines, annotator):
     """ """
     line_offset = 23
-    source_map, line2names, name2lines, head_lns, lineno = si.annotate(sourcelines, line_offset, 42)
+    source_map, line2names, name2lines, head_lns, lineno = si.annotate(sourcelines, line_offset, 42, annotator=annotator)
 
     # see that we didn't forget or invent any lines
     assert len(source_map) == len(sourcelines)
@@ -32,4 +34,47 @@ def test_source_annotation(sourcelines):
     assert head_lns == [k + line_offset for k in [4,5,6,7]]
 
     # ... and that lineno survived the roundtrip
-    assert lineno == 42
\ No newline at end of file
+    assert lineno == 42
+
+@pytest.mark.parametrize('annotator', si.ANNOTATORS)
+def test_source_map_views(sourcelines, annotator):
+    source_map, *_ = si.annotate(sourcelines, 1, 20, annotator=annotator)
+
+    for ln in [1, 10, 20]:
+        assert source_map.line(ln) == sourcelines[ln - 1]
+        assert source_map.line(ln) == ''.join(s for s, _ in source_map[ln])
+
+    # `foo = somelist`
+    assert list(source_map.var_names(17)) == ['foo', 'somelist']
+
+    view = source_map.select([15, 17], dedent=4)
+    assert list(view) == [15, 17]
+    assert 16 not in view
+    assert view.line(17) == sourcelines[16][4:]
+    assert view[17][0] == ('', 'RAW')
+
+
+def test_join_broken_lines(sourcelines):
+    plain = sourcelines[:50]
+    lines, corrections = si.join_broken_lines(plain)
+    assert lines is plain
+    assert len(corrections) == 0
+
+    lines, corrections = si.join_broken_lines(sourcelines)
+    assert len(lines) == len(sourcelines)
+    # `bla = val.T.\` continues over the next two lines (indices 55 to 57)
+    assert lines[55].strip() == 'bla = val.T.T.T.T'
+    assert [corrections[k] for k in [55, 56, 57, 58]] == [0, -1, -1, 0]
+
+
+def test_ast_annotator():
+    source = ["    def method(self, x, y=dict(z=1)):\n",
+              "        return x.strip().lower() + self.foo.bar\n"]
+    source_map, line2names, name2lines, head_lns, _ = si.annotate(source, 10, annotator='ast')
+    assert line2names[10] == ['method', 'self', 'x', 'y', 'dict']
+    assert line2names[11] == ['x.strip', 'self.foo.bar']
+    assert head_lns == [10]
+
+    # tokens only get looked at when asked for, from views just the same
+    view = source_map.select([11])
+    assert list(view.var_names(11)) == ['x.strip', 'lower', 'self.foo.bar']
@@ -1,6 +1,7 @@
 import re
 
-from stackprinter.utils import match
+from stackprinter.utils import (match, merge_line_ranges, path_matcher,
+                                inspect_callable)
 
 
 def test_match():
@@ -11,3 +12,32 @@ def test_match():
     assert match('my/ignored/path', 'ignored')
     assert match('my/ignored/path', ['not', 'ignored'])
     assert match('my/ignored/path', [re.compile('not ignored'), re.compile('ignored')])
+
+
+def test_merge_line_ranges():
+    assert merge_line_ranges([], range(5, 8)) == range(5, 8)
+    assert merge_line_ranges([3, 4], range(5, 8)) == range(3, 8)
+    assert merge_line_ranges([3, 4, 5, 6], [6]) == range(3, 7)
+    assert merge_line_ranges([1, 2], range(5, 7)) == [1, 2, 5, 6]
+
+
+def test_path_matcher():
+    is_ignored = path_matcher(['not', 'ignored'])
+    assert is_ignored('my/ignored/path')
+    assert is_ignored('my/ignored/path')
+    assert not is_ignored('my/path')
+    assert not is_ignored(None)
+
+
+def test_inspect_callable():
+    class Thing():
+        def method(self):
+            pass
+
+    thing = Thing()
+    for _ in range(2):
+        qname, path, owner, ln = inspect_callable(thing.method)
+        assert qname.endswith('Thing.method')
+        assert path == __file__
+        assert owner is thing
+    assert inspect_callable(len) == (None, None, None, None)